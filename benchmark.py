@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+"""
+Benchmarks reproducibles de upload_server.py.
+
+Levanta un servidor de thumbnails falso (latencia, proporcion de 404 y ancho
+de banda configurables), genera arboles de ROMs sinteticos y arranca
+upload_server.py como proceso aparte apuntando a ellos. Los resultados se
+escriben en JSON para comparar versiones:
+
+    python3 benchmark.py --roms 1000 --latency-ms 40 --miss-ratio 0.5 -o antes.json
+"""
+
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import upload_server
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+UPLOAD_SERVER = os.path.join(BASE_DIR, "upload_server.py")
+BENCHMARKS = ("placeholder", "upload", "scan")
+SCAN_CONSOLE = "gba"
+SCAN_SYSTEM = "Nintendo - Game Boy Advance"
+
+
+def stats(values):
+    """Resumen de una lista de tiempos (en las unidades de entrada)"""
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered), 3),
+        'p50': round(pct(50), 3),
+        'p95': round(pct(95), 3),
+        'p99': round(pct(99), 3),
+        'max': round(ordered[-1], 3),
+    }
+
+
+# --- Servidor de thumbnails falso ---
+
+class FakeThumbnailHandler(BaseHTTPRequestHandler):
+    """Imita thumbnails.libretro.com: /<Sistema>/<Tipo>/<Nombre>.png"""
+
+    protocol_version = 'HTTP/1.1'
+    NOT_FOUND = b"<html><head><title>404 Not Found</title></head><body><h1>Not Found</h1></body></html>"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        # Mismo resultado para la misma ruta en todas las ejecuciones
+        digest = int(hashlib.sha1(self.path.encode()).hexdigest()[:8], 16)
+        missing = digest / 0xFFFFFFFF < server.miss_ratio
+        body = self.NOT_FOUND if missing else server.png
+        with server.lock:
+            server.requests += 1
+            server.bytes_sent += len(body) if send_body else 0
+        self.send_response(404 if missing else 200)
+        self.send_header('Content-Type', 'text/html' if missing else 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not send_body:
+            return
+        if missing or not server.throughput:
+            self.wfile.write(body)
+            return
+        chunk = 16 * 1024
+        for start in range(0, len(body), chunk):
+            self.wfile.write(body[start:start + chunk])
+            time.sleep(len(body[start:start + chunk]) / server.throughput)
+
+
+def start_fake_host(latency, miss_ratio, throughput, workdir):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeThumbnailHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.miss_ratio = miss_ratio
+    server.throughput = throughput
+    # Peticiones y bytes de cuerpo servidos, para comparar el coste por ROM
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.bytes_sent = 0
+    # Una caratula real para que el escaneo genere tambien las miniaturas
+    path = os.path.join(workdir, "boxart.png")
+    upload_server.create_placeholder_png(path, "Boxart", "Fake")
+    with open(path, 'rb') as f:
+        server.png = f.read()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- ROMs sinteticas y servidor bajo prueba ---
+
+def make_rom_tree(roms_dir, console, count, rom_size):
+    """Crear count ROMs dispersas de rom_size bytes con contenido distinto"""
+    folder = os.path.join(roms_dir, console)
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        with open(os.path.join(folder, f"Synthetic Game {i:05d} (USA).{console}"), 'wb') as f:
+            f.write(i.to_bytes(8, 'little'))
+            f.truncate(rom_size)
+    return folder
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ServerProcess:
+    """upload_server.py en un proceso aparte con carpetas temporales"""
+
+    def __init__(self, workdir, **env):
+        self.roms_dir = os.path.join(workdir, "roms")
+        self.thumbs_dir = os.path.join(workdir, "thumbnails")
+        os.makedirs(self.roms_dir, exist_ok=True)
+        os.makedirs(self.thumbs_dir, exist_ok=True)
+        self.port = free_port()
+        self.env = dict(os.environ, ROMS_DIR=self.roms_dir, THUMBNAILS_DIR=self.thumbs_dir,
+                        UPLOAD_SERVER_PORT=str(self.port), **{k: str(v) for k, v in env.items()})
+        self.log_path = os.path.join(workdir, "server.log")
+        self.proc = None
+
+    def __enter__(self):
+        self.log = open(self.log_path, 'ab')
+        self.proc = subprocess.Popen([sys.executable, UPLOAD_SERVER], env=self.env,
+                                     stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + 15
+        while time.time() < deadline:
+            try:
+                self.request('GET', '/thumbs/status')
+                return self
+            except OSError:
+                time.sleep(0.1)
+        self.__exit__(None, None, None)
+        raise RuntimeError(f"upload_server.py did not start (see {self.log_path})")
+
+    def __exit__(self, *exc):
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.log.close()
+
+    def connection(self, timeout=120):
+        return http.client.HTTPConnection('127.0.0.1', self.port, timeout=timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        conn = self.connection()
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            resp = conn.getresponse()
+            data = resp.read()
+        finally:
+            conn.close()
+        if resp.status >= 400:
+            raise RuntimeError(f"{method} {path}: HTTP {resp.status} {data[:200]!r}")
+        return json.loads(data) if data else None
+
+    def peak_rss_kb(self):
+        """Pico de memoria residente del servidor (solo Linux)"""
+        try:
+            with open(f"/proc/{self.proc.pid}/status") as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+
+# --- Benchmarks ---
+
+def _send_pattern(conn, size, chunk=1024 * 1024):
+    block = os.urandom(chunk)
+    sent = 0
+    while sent < size:
+        part = block[:min(chunk, size - sent)]
+        conn.send(part)
+        sent += len(part)
+
+
+def upload_multipart(server, size):
+    boundary = uuid.uuid4().hex
+    name = f"bench-{uuid.uuid4().hex[:8]}.gba"
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"folder\"\r\n\r\n{SCAN_CONSOLE}\r\n"
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{name}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    conn = server.connection()
+    try:
+        conn.putrequest('POST', '/upload/rom')
+        conn.putheader('Content-Type', f'multipart/form-data; boundary={boundary}')
+        conn.putheader('Content-Length', str(len(head) + size + len(tail)))
+        conn.endheaders()
+        conn.send(head)
+        _send_pattern(conn, size)
+        conn.send(tail)
+        resp = conn.getresponse()
+        resp.read()
+    finally:
+        conn.close()
+    if resp.status != 200:
+        raise RuntimeError(f"multipart upload failed: HTTP {resp.status}")
+
+
+def upload_session(server, size):
+    session = server.request('POST', '/upload/session', json.dumps({
+        'folder': SCAN_CONSOLE, 'filename': f"bench-{uuid.uuid4().hex[:8]}.gba", 'size': size,
+    }), {'Content-Type': 'application/json'})
+    chunk = session['chunk_size']
+    for offset in range(0, size, chunk):
+        length = min(chunk, size - offset)
+        conn = server.connection()
+        try:
+            conn.putrequest('PUT', f"/upload/session/{session['id']}?offset={offset}")
+            conn.putheader('Content-Length', str(length))
+            conn.endheaders()
+            _send_pattern(conn, length)
+            resp = conn.getresponse()
+            resp.read()
+        finally:
+            conn.close()
+        if resp.status != 200:
+            raise RuntimeError(f"chunk upload failed: HTTP {resp.status}")
+    server.request('POST', f"/upload/session/{session['id']}/finalize")
+
+
+def bench_upload(args, workdir):
+    """Velocidad de subida y pico de RSS del servidor por tamaño y metodo"""
+    results = []
+    for size in args.upload_sizes:
+        for method, upload in (('multipart', upload_multipart), ('session', upload_session)):
+            # Un servidor nuevo por medida: el pico de RSS no baja nunca
+            run_dir = os.path.join(workdir, f"upload-{method}-{size}")
+            with ServerProcess(run_dir, PLACEHOLDER_PROCESSES=0) as server:
+                baseline = server.peak_rss_kb()
+                started = time.perf_counter()
+                upload(server, size)
+                elapsed = time.perf_counter() - started
+                peak = server.peak_rss_kb()
+            results.append({
+                'method': method,
+                'size_bytes': size,
+                'seconds': round(elapsed, 3),
+                'mb_per_s': round(size / elapsed / 1e6, 2),
+                'peak_rss_kb': peak,
+                'rss_growth_kb': peak - baseline if peak is not None and baseline is not None else None,
+            })
+            log(f"upload {method} {size} bytes: {results[-1]['mb_per_s']} MB/s, peak RSS {peak} kB")
+    return results
+
+
+def bench_scan(args, workdir):
+    """Tiempo de escaneo contra el host falso y latencia de /thumbs/status mientras dura"""
+    fake = start_fake_host(args.latency_ms / 1000, args.miss_ratio, args.throughput, workdir)
+    try:
+        with ServerProcess(os.path.join(workdir, "scan"),
+                           LIBRETRO_THUMBS_URL=f"http://127.0.0.1:{fake.server_address[1]}") as server:
+            make_rom_tree(server.roms_dir, SCAN_CONSOLE, args.roms, args.rom_size)
+            latencies = []
+            errors = []
+            lock = threading.Lock()
+            done = threading.Event()
+
+            def poller():
+                while not done.is_set():
+                    started = time.perf_counter()
+                    try:
+                        server.request('GET', '/thumbs/status')
+                    except (OSError, RuntimeError) as e:
+                        with lock:
+                            errors.append(str(e))
+                        continue
+                    with lock:
+                        latencies.append((time.perf_counter() - started) * 1000)
+                    time.sleep(args.poll_interval)
+
+            threads = [threading.Thread(target=poller, daemon=True) for _ in range(args.pollers)]
+            started = time.perf_counter()
+            server.request('POST', '/thumbs/scan', json.dumps({
+                'console': SCAN_CONSOLE, 'system': SCAN_SYSTEM, 'extensions': ['.gba'],
+            }), {'Content-Type': 'application/json'})
+            for t in threads:
+                t.start()
+            while True:
+                status = server.request('GET', '/thumbs/status')
+                if not status['running'] and status['finished_at']:
+                    break
+                time.sleep(0.1)
+            wall = time.perf_counter() - started
+            done.set()
+            for t in threads:
+                t.join()
+    finally:
+        fake.shutdown()
+    result = {
+        'roms': args.roms,
+        'wall_seconds': round(wall, 3),
+        'seconds_per_1k_roms': round(wall / max(1, args.roms) * 1000, 3),
+        'found': status['found'],
+        'generated': status['generated'],
+        'failed': status['failed'],
+        'upstream_requests_per_rom': round(fake.requests / max(1, args.roms), 3),
+        'upstream_bytes_per_rom': round(fake.bytes_sent / max(1, args.roms)),
+        'status_poll_ms': stats(latencies),
+        'status_poll_errors': len(errors),
+    }
+    log(f"scan {args.roms} ROMs: {result['wall_seconds']} s, {result['upstream_requests_per_rom']} upstream requests/ROM, "
+        f"status p95 {result['status_poll_ms'].get('p95')} ms")
+    return result
+
+
+def bench_placeholder(args, workdir):
+    """Tiempo por imagen de create_placeholder_png y de write_png (en este proceso)"""
+    placeholder = []
+    encode = []
+    rgba = upload_server.gradient_background(512, 512)
+    for i in range(args.images):
+        path = os.path.join(workdir, f"placeholder-{i}.png")
+        started = time.perf_counter()
+        upload_server.create_placeholder_png(path, f"Synthetic Game {i:05d}", SCAN_SYSTEM)
+        placeholder.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        upload_server.write_png(path, 512, 512, rgba)
+        encode.append((time.perf_counter() - started) * 1000)
+        os.remove(path)
+    result = {'create_placeholder_png_ms': stats(placeholder), 'write_png_ms': stats(encode)}
+    log(f"placeholder p50 {result['create_placeholder_png_ms']['p50']} ms, "
+        f"write_png p50 {result['write_png_ms']['p50']} ms")
+    return result
+
+
+def log(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+
+def parse_size(text):
+    """'512', '64K', '4M', '1.5G' -> bytes"""
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    text = text.strip().lower()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def parse_sizes(text):
+    return [parse_size(part) for part in text.split(',') if part.strip()]
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', '-C', BASE_DIR, 'describe', '--always', '--dirty'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de upload_server.py (resultado en JSON)")
+    parser.add_argument('--only', default=','.join(BENCHMARKS),
+                        help=f"benchmarks a ejecutar, separados por comas ({', '.join(BENCHMARKS)})")
+    parser.add_argument('--roms', type=int, default=1000, help="ROMs sinteticas para el escaneo")
+    parser.add_argument('--rom-size', type=parse_size, default=4 * 1024 ** 2,
+                        help="tamaño de cada ROM sintetica (dispersa), p. ej. 4M")
+    parser.add_argument('--latency-ms', type=float, default=50, help="latencia del host de thumbnails falso")
+    parser.add_argument('--miss-ratio', type=float, default=0.5, help="proporcion de 404 del host falso (0-1)")
+    parser.add_argument('--throughput', type=parse_size, default=0,
+                        help="ancho de banda del host falso en bytes/s (0 = sin limite), p. ej. 2M")
+    parser.add_argument('--pollers', type=int, default=4, help="clientes consultando /thumbs/status durante el escaneo")
+    parser.add_argument('--poll-interval', type=float, default=0.05, help="segundos entre consultas de cada cliente")
+    parser.add_argument('--upload-sizes', type=parse_sizes, default=parse_sizes("1M,16M,128M"),
+                        help="tamaños de subida, p. ej. 1M,16M,128M")
+    parser.add_argument('--images', type=int, default=20, help="imagenes para el benchmark de placeholders")
+    parser.add_argument('-o', '--output', help="fichero JSON de salida (por defecto, stdout)")
+    args = parser.parse_args()
+
+    selected = [name.strip() for name in args.only.split(',') if name.strip()]
+    for name in selected:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    report = {
+        'version': git_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'params': {k: v for k, v in vars(args).items() if k not in ('only', 'output')},
+        'results': {},
+    }
+    runners = {'placeholder': bench_placeholder, 'upload': bench_upload, 'scan': bench_scan}
+    with tempfile.TemporaryDirectory(prefix="upload-bench-") as workdir:
+        for name in selected:
+            report['results'][name] = runners[name](args, workdir)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
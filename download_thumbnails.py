@@ -4,16 +4,43 @@ Descarga thumbnails de libretro para todos los ROMs.
 Versión mejorada que intenta directamente sin lista completa.
 """
 
+import argparse
+import json
 import os
 import re
-import urllib.request
+import sys
+import threading
+import time
+import urllib.error
 import urllib.parse
+import uuid
 from pathlib import Path
 from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Clases compartidas con upload_server.py (mismo directorio)
+from upload_server import (CandidateStats, LookupCache, LibretroNameIndex, RomDatIndex, RomIdCache,
+                           LIBRETRO_HEAD_BELOW, identify_libretro_name, probe_url)
 
 # Configuracion
 ROMS_DIR = "/mnt/Expansion/roms"
 THUMBNAILS_DIR = "/home/kroryan/docker-data/roms-server/thumbnails"
+# Caches propias del script: usa otros nombres de sistema, otro host (GitHub)
+# y otras rutas de ROM que el servidor, asi que no comparte entradas con el y
+# escribir el mismo fichero solo haria que uno pisara al otro
+LOOKUP_CACHE_PATH = os.path.join(THUMBNAILS_DIR, ".cache", "download_lookup_cache.json")
+# Listados locales de libretro-thumbnails (ver README); si existen se resuelve
+# el nombre en memoria y se hace una sola descarga por ROM
+LIBRETRO_INDEX_DIR = os.environ.get("LIBRETRO_INDEX_DIR", os.path.join(THUMBNAILS_DIR, ".cache", "libretro_index"))
+# DATs No-Intro locales: las ROMs que aparecen se descargan por su nombre canonico
+ROM_DAT_DIR = os.environ.get("ROM_DAT_DIR", os.path.join(THUMBNAILS_DIR, ".cache", "dats"))
+ROM_IDS_PATH = os.path.join(THUMBNAILS_DIR, ".cache", "download_rom_ids.json")
+# Aciertos por sistema de cada patron de nombre (se prueban primero los que
+# mas aciertan) y tipo de thumbnail (los que suelen fallar se comprueban con HEAD)
+CANDIDATE_STATS_PATH = os.path.join(THUMBNAILS_DIR, ".cache", "download_candidate_stats.json")
+# Resultado de cada ROM (hit, miss o error): las ejecuciones siguientes
+# continuan donde se quedo la anterior
+JOURNAL_PATH = os.path.join(THUMBNAILS_DIR, ".cache", "download_journal.jsonl")
 
 CONSOLES = {
     "gba": {
@@ -73,6 +100,18 @@ NAME_PATTERNS = [
     "{original}",
 ]
 
+# Formato especial de Pokemon: "Pokemon - X Version (USA, Europe)"
+POKEMON_PATTERNS = [
+    "Pokemon - {pokemon} Version (USA, Europe)",
+    "Pokemon - {pokemon} Version (USA)",
+    "Pokemon - {pokemon} Version (Europe)",
+    "Pokemon - {pokemon} Version",
+    "Pokemon - {pokemon} (USA, Europe)",
+    "Pokemon - {pokemon} (USA)",
+    "Pokemon - {pokemon} (Europe)",
+    "Pokemon - {pokemon}",
+]
+
 # Traducciones comunes ES/EU -> EN
 TRANSLATIONS = {
     # Pokemon
@@ -140,8 +179,8 @@ def translate_name(name):
         translated.append(TRANSLATIONS.get(word, word))
     return ' '.join(translated)
 
-def get_possible_names(rom_filename):
-    """Generar lista de posibles nombres a intentar"""
+def get_name_candidates(rom_filename):
+    """Generar pares (patron, nombre) a intentar, en el orden por defecto"""
     base_name = re.sub(r'\.[^.]+$', '', rom_filename)
     clean = clean_name(rom_filename)
     translated = translate_name(clean)
@@ -160,14 +199,8 @@ def get_possible_names(rom_filename):
         # La segunda palabra es el nombre del juego (Emerald, Ruby, etc)
         pokemon_name = words[1].title()
         # "Pokemon - Emerald Version (USA, Europe)"
-        possible.append(f"Pokemon - {pokemon_name} Version (USA, Europe)")
-        possible.append(f"Pokemon - {pokemon_name} Version (USA)")
-        possible.append(f"Pokemon - {pokemon_name} Version (Europe)")
-        possible.append(f"Pokemon - {pokemon_name} Version")
-        possible.append(f"Pokemon - {pokemon_name} (USA, Europe)")
-        possible.append(f"Pokemon - {pokemon_name} (USA)")
-        possible.append(f"Pokemon - {pokemon_name} (Europe)")
-        possible.append(f"Pokemon - {pokemon_name}")
+        for pattern in POKEMON_PATTERNS:
+            possible.append((pattern, pattern.format(pokemon=pokemon_name)))
 
     # PATRONES GENERALES
     for pattern in NAME_PATTERNS:
@@ -180,106 +213,326 @@ def get_possible_names(rom_filename):
                 first_word=first_word,
                 rest=rest
             )
-            if name and name not in possible:
-                possible.append(name)
+            if name and all(name != other for _, other in possible):
+                possible.append((pattern, name))
         except KeyError:
             # Si el patron tiene una clave que no tenemos, saltar
             pass
 
     return possible
 
-def download_thumbnail(system_libretro, game_name, output_path):
+def get_possible_names(rom_filename):
+    """Generar lista de posibles nombres a intentar"""
+    return [name for _, name in get_name_candidates(rom_filename)]
+
+def download_thumbnail(system_libretro, game_name, output_path, cache=None, types=None, stats=None, recheck=False):
     """Descargar thumbnail desde libretro GitHub"""
     repo_name = system_libretro
     base_url = f"https://raw.githubusercontent.com/libretro-thumbnails/{repo_name}/master"
 
-    types = ["Named_Boxarts", "Named_Snaps", "Named_Titles"]
+    types = types or ["Named_Boxarts", "Named_Snaps", "Named_Titles"]
+    error = None
+    answered = False
 
     for thumb_type in types:
+        # Saltar nombres que ya dieron 404 en ejecuciones anteriores (salvo al reintentar)
+        if cache and not recheck and cache.is_miss(system_libretro, game_name, thumb_type):
+            continue
+
         # GitHub usa espacios URL-encoded
         encoded_name = urllib.parse.quote(game_name + '.png')
         url = f"{base_url}/{thumb_type}/{encoded_name}"
+        # Solo se descarga el cuerpo si el candidato es probable o ya existe (HEAD)
+        likely = len(types) == 1 or (stats and stats.rate(system_libretro, "type", thumb_type) >= LIBRETRO_HEAD_BELOW)
 
         try:
-            req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-            with urllib.request.urlopen(req, timeout=15) as response:
-                if response.status == 200:
-                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                    with open(output_path, 'wb') as f:
-                        f.write(response.read())
-                    return True, thumb_type
-        except urllib.error.HTTPError as e:
-            if e.code == 404:
-                continue
-            else:
-                raise
-        except Exception:
+            status, body = probe_url(url, likely, timeout=15)
+        except Exception as e:
+            error = e
             continue
 
-    return False, None
-
-def main():
-    print("=== Descargador de Thumbnails para ROMs (v3 - Directo) ===\n")
-
-    total_found = 0
-    total_downloaded = 0
-    total_failed = 0
-
-    for console, info in CONSOLES.items():
-        console_path = os.path.join(ROMS_DIR, console)
-        if not os.path.exists(console_path):
-            print(f"[SKIP] Carpeta no existe: {console_path}")
+        if stats and status in (200, 404):
+            stats.record(system_libretro, "type", thumb_type, status == 200)
+        if status == 200:
+            # Fichero temporal: un thumbnail a medias no debe contar como hecho
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, output_path)
+            if cache:
+                cache.put(system_libretro, game_name, thumb_type, "hit")
+            return True, thumb_type
+        if status == 404:
+            if cache:
+                cache.put(system_libretro, game_name, thumb_type, "miss")
+            answered = True
             continue
+        raise urllib.error.HTTPError(url, status, f"HTTP {status}", None, None)
+
+    # Sin respuesta definitiva de algun tipo: no se puede dar por no encontrado
+    if error:
+        raise error
+    # Todo venia de 404 recordados: None para no contarlo como un fallo nuevo
+    return (False if answered else None), None
+
+class Journal:
+    """Resultado de cada ROM en un fichero JSON lines (una linea por intento).
+
+    Al abrirlo se queda con la ultima linea de cada ROM y lo reescribe
+    compactado; despues cada resultado se añade al final en cuanto se
+    conoce, asi que una ejecucion interrumpida pierde como mucho las ROMs
+    que estaban en curso.
+    """
+
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if not restart:
+            try:
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                            self.entries[self.key(entry['console'], entry['rom'])] = entry
+                        except (ValueError, KeyError, TypeError):
+                            # Ultima linea cortada por una interrupcion
+                            continue
+            except OSError:
+                pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, path)
+        self.file = open(path, 'a')
+
+    @staticmethod
+    def key(console, rom):
+        return f"{console}/{rom}"
+
+    def get(self, console, rom, st):
+        """Ultimo resultado de la ROM, si sigue siendo el mismo fichero"""
+        entry = self.entries.get(self.key(console, rom))
+        if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+            return entry
+        return None
+
+    def record(self, console, rom, st, outcome, source=None, thumb_type=None, error=None):
+        entry = {
+            'console': console,
+            'rom': rom,
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+            'outcome': outcome,
+            'source': source,
+            'type': thumb_type,
+            'error': error,
+            'at': int(time.time())
+        }
+        with self.lock:
+            self.entries[self.key(console, rom)] = entry
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+        return entry
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def is_pending(entry, thumb_path, retry_failed):
+    """Si hay que procesar una ROM segun su ultimo resultado en el diario"""
+    if retry_failed:
+        return bool(entry) and entry['outcome'] in ("miss", "error")
+    if not entry:
+        return True
+    if entry['outcome'] == "hit":
+        # Thumbnail borrado a mano despues de descargarlo
+        return not os.path.exists(thumb_path)
+    # Un "miss" es definitivo (--retry-failed lo repite); un error no
+    return entry['outcome'] == "error"
+
+def find_thumbnail(ctx, console, info, rom, thumb_path):
+    """Buscar y descargar el thumbnail de una ROM: (resultado, nombre, tipo, error)"""
+    console_path = os.path.join(ROMS_DIR, console)
+    # Obtener nombres posibles y probar cada uno
+    candidates = get_name_candidates(rom)
+    system = info['libretro']
+    tried = []
+    last_error = None
+
+    identified = identify_libretro_name(os.path.join(console_path, rom), system, ctx['rom_ids'], ctx['dats'])
+    index = ctx['index']
+    stats = ctx['stats']
+    if identified:
+        # Identificada por CRC en el DAT: un solo nombre exacto
+        system, dat_name = identified
+        candidates = [(None, dat_name)]
+        match = index.resolve(system, dat_name) if index.has_system(system) else None
+        types = [match[1]] if match and match[0] == dat_name else None
+    elif index.has_system(system):
+        # Resolver contra el indice local: solo se descarga el nombre exacto
+        for _, name in candidates:
+            match = index.resolve(system, name)
+            if match:
+                candidates = [(None, match[0])]
+                types = [match[1]]
+                break
+        else:
+            candidates = []
+    else:
+        # A ciegas: primero los patrones que mas aciertan en este sistema
+        candidates = stats.order(system, "pattern", candidates, key=lambda c: c[0])
+        types = None
+
+    for pattern, name in candidates[:15]:  # Limitar a 15 intentos
+        if name in tried:
+            continue
+        tried.append(name)
+        try:
+            ok, thumb_type = download_thumbnail(system, name, thumb_path, ctx['cache'], types, stats,
+                                                recheck=ctx['recheck'])
+        except Exception as e:
+            # Error de red o del servidor: se siguen probando los demas nombres
+            last_error = f"{name}: {e}"
+            continue
+        if pattern and ok is not None:
+            stats.record(system, "pattern", pattern, ok)
+        if ok:
+            return "hit", name, thumb_type, None
+
+    if last_error:
+        return "error", None, None, last_error
+    return "miss", None, None, None
+
+def process_rom(ctx, console, info, rom, st):
+    """Procesar una ROM y apuntar el resultado en el diario"""
+    base_name = re.sub(r'\.[^.]+$', '', rom)
+    thumb_path = os.path.join(THUMBNAILS_DIR, console, f"{base_name}.png")
+    if os.path.exists(thumb_path):
+        entry = ctx['journal'].record(console, rom, st, "hit", source="existing")
+    else:
+        try:
+            outcome, source, thumb_type, error = find_thumbnail(ctx, console, info, rom, thumb_path)
+        except Exception as e:
+            outcome, source, thumb_type, error = "error", None, None, str(e)
+        entry = ctx['journal'].record(console, rom, st, outcome, source, thumb_type, error)
+
+    if entry['source'] == "existing":
+        label = "[EXISTE]"
+    elif entry['outcome'] == "hit":
+        short_name = entry['source'][:30] + "..." if len(entry['source']) > 30 else entry['source']
+        label = f"[OK] {short_name}"
+    elif entry['outcome'] == "miss":
+        label = "[NO ENCONTRADO]"
+    else:
+        label = f"[ERROR] {entry['error']}"
+    with ctx['print_lock']:
+        ctx['done'] += 1
+        print(f"  [{ctx['done']}/{ctx['total']}] {console:<5} {base_name[:45]:<45} {label}", flush=True)
+    return entry['outcome']
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Descarga thumbnails de libretro para todas las ROMs. El progreso se guarda "
+                    "en un diario y al volver a ejecutarlo solo se procesa lo que falta.")
+    parser.add_argument('-c', '--console', action='append', choices=sorted(CONSOLES), dest='consoles',
+                        help="consola a procesar (se puede repetir; por defecto todas)")
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help="ROMs que se buscan a la vez (por defecto 4)")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="procesar solo las ROMs que quedaron sin encontrar o con error")
+    parser.add_argument('--journal', default=JOURNAL_PATH,
+                        help=f"diario de resultados (por defecto {JOURNAL_PATH})")
+    parser.add_argument('--restart', action='store_true',
+                        help="olvidar el diario y empezar de cero")
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error("--jobs debe ser al menos 1")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    print("=== Descargador de Thumbnails para ROMs (v3 - Directo) ===\n")
 
-        print(f"\n=== {console.upper()} ===")
-
-        # Listar ROMs
-        roms = []
-        for file in sorted(os.listdir(console_path)):
-            if any(file.lower().endswith(ext) for ext in info['extensions']):
-                roms.append(file)
-
-        print(f"ROMs locales: {len(roms)}\n")
-        total_found += len(roms)
-
-        for i, rom in enumerate(roms, 1):
-            base_name = re.sub(r'\.[^.]+$', '', rom)
-            thumb_path = os.path.join(THUMBNAILS_DIR, console, f"{base_name}.png")
-
-            # Saltar si ya existe
-            if os.path.exists(thumb_path):
-                print(f"  [{i}/{len(roms)}] {base_name[:45]:<45} [EXISTE]")
-                total_downloaded += 1
+    journal = Journal(args.journal, restart=args.restart)
+    ctx = {
+        'cache': LookupCache(LOOKUP_CACHE_PATH),
+        'index': LibretroNameIndex(LIBRETRO_INDEX_DIR),
+        'dats': RomDatIndex(ROM_DAT_DIR),
+        'rom_ids': RomIdCache(ROM_IDS_PATH),
+        'stats': CandidateStats(CANDIDATE_STATS_PATH),
+        'journal': journal,
+        # Al reintentar fallos no sirven los 404 recordados de la vez anterior
+        'recheck': args.retry_failed,
+        'print_lock': threading.Lock(),
+        'done': 0,
+        'total': 0
+    }
+    totals = {"hit": 0, "miss": 0, "error": 0}
+    total_roms = 0
+    skipped = 0
+    interrupted = False
+
+    executor = ThreadPoolExecutor(max_workers=args.jobs)
+    try:
+        for console in args.consoles or CONSOLES:
+            info = CONSOLES[console]
+            console_path = os.path.join(ROMS_DIR, console)
+            if not os.path.exists(console_path):
+                print(f"[SKIP] Carpeta no existe: {console_path}")
                 continue
 
-            print(f"  [{i}/{len(roms)}] {base_name[:45]:<45}", end=" ", flush=True)
-
-            # Obtener nombres posibles y probar cada uno
-            possible_names = get_possible_names(rom)
-            success = False
-            tried = []
-
-            for name in possible_names[:15]:  # Limitar a 15 intentos
-                if name in tried:
+            # Listar ROMs y quedarse con las que no estan terminadas
+            roms = []
+            for file in sorted(os.listdir(console_path)):
+                if not any(file.lower().endswith(ext) for ext in info['extensions']):
                     continue
-                tried.append(name)
-                ok, thumb_type = download_thumbnail(info['libretro'], name, thumb_path)
-                if ok:
-                    short_name = name[:30] + "..." if len(name) > 30 else name
-                    print(f"[OK] {short_name}")
-                    total_downloaded += 1
-                    success = True
-                    break
-
-            if not success:
-                print("[NO ENCONTRADO]")
-                total_failed += 1
+                total_roms += 1
+                base_name = re.sub(r'\.[^.]+$', '', file)
+                thumb_path = os.path.join(THUMBNAILS_DIR, console, f"{base_name}.png")
+                st = os.stat(os.path.join(console_path, file))
+                if is_pending(journal.get(console, file, st), thumb_path, args.retry_failed):
+                    roms.append((file, st))
+                else:
+                    skipped += 1
+
+            print(f"\n=== {console.upper()} ===")
+            print(f"ROMs pendientes: {len(roms)}\n")
+            ctx['done'] = 0
+            ctx['total'] = len(roms)
+
+            futures = [executor.submit(process_rom, ctx, console, info, rom, st) for rom, st in roms]
+            for future in as_completed(futures):
+                totals[future.result()] += 1
+
+            ctx['cache'].save()
+            ctx['stats'].save()
+            ctx['rom_ids'].save()
+    except KeyboardInterrupt:
+        interrupted = True
+        print("\n[INTERRUMPIDO] Esperando a las ROMs en curso...")
+        executor.shutdown(wait=True, cancel_futures=True)
+    finally:
+        executor.shutdown(wait=True)
+        ctx['cache'].save()
+        ctx['stats'].save()
+        ctx['rom_ids'].save()
+        journal.close()
 
     print(f"\n=== RESUMEN ===")
-    print(f"Total ROMs: {total_found}")
-    print(f"Thumbnails: {total_downloaded}")
-    print(f"No encontrados: {total_failed}")
+    print(f"Total ROMs: {total_roms}")
+    print(f"Ya terminadas (diario): {skipped}")
+    print(f"Thumbnails: {totals['hit']}")
+    print(f"No encontrados: {totals['miss']}")
+    print(f"Errores: {totals['error']}")
     print(f"\nGuardados en: {THUMBNAILS_DIR}")
+    print(f"Diario: {args.journal}")
+    if interrupted:
+        print("Vuelve a ejecutar el script para continuar donde se quedo.")
+        sys.exit(130)
 
 if __name__ == "__main__":
     main()
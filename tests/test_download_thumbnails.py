@@ -0,0 +1,65 @@
+"""Pruebas del diario de download_thumbnails.py"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import download_thumbnails as dt
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.path = os.path.join(self.tmp, 'journal.jsonl')
+        self.rom = os.path.join(self.tmp, 'Game.gba')
+        with open(self.rom, 'wb') as f:
+            f.write(b'rom')
+        self.st = os.stat(self.rom)
+
+    def test_compacts_to_last_entry_and_skips_cut_line(self):
+        journal = dt.Journal(self.path)
+        journal.record('gba', 'Game.gba', self.st, 'error', error='timeout')
+        journal.record('gba', 'Game.gba', self.st, 'hit', source='Game (USA)')
+        journal.record('gba', 'Other.gba', self.st, 'miss')
+        journal.close()
+        with open(self.path, 'a') as f:
+            f.write('{"console": "gba", "rom": "Cut')
+
+        journal = dt.Journal(self.path)
+        self.addCleanup(journal.close)
+        self.assertEqual(journal.get('gba', 'Game.gba', self.st)['outcome'], 'hit')
+        with open(self.path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(sorted((e['rom'], e['outcome']) for e in lines),
+                         [('Game.gba', 'hit'), ('Other.gba', 'miss')])
+        # Sin temporales de la compactacion
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['Game.gba', 'journal.jsonl'])
+
+    def test_changed_rom_is_pending_again(self):
+        journal = dt.Journal(self.path)
+        self.addCleanup(journal.close)
+        journal.record('gba', 'Game.gba', self.st, 'miss')
+        self.assertIsNotNone(journal.get('gba', 'Game.gba', self.st))
+        with open(self.rom, 'ab') as f:
+            f.write(b'patched')
+        self.assertIsNone(journal.get('gba', 'Game.gba', os.stat(self.rom)))
+
+    def test_is_pending(self):
+        thumb = os.path.join(self.tmp, 'Game.png')
+        self.assertTrue(dt.is_pending(None, thumb, False))
+        self.assertTrue(dt.is_pending({'outcome': 'hit'}, thumb, False))
+        open(thumb, 'wb').close()
+        self.assertFalse(dt.is_pending({'outcome': 'hit'}, thumb, False))
+        self.assertFalse(dt.is_pending({'outcome': 'miss'}, thumb, False))
+        self.assertTrue(dt.is_pending({'outcome': 'error'}, thumb, False))
+        self.assertTrue(dt.is_pending({'outcome': 'miss'}, thumb, True))
+        self.assertFalse(dt.is_pending(None, thumb, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
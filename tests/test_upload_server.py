@@ -0,0 +1,331 @@
+"""Pruebas de los parsers y codecs de upload_server.py (solo stdlib)"""
+import io
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+import zipfile
+import zlib
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import upload_server as us
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+
+
+def multipart_body(boundary, fields, files):
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode()
+                     + value.encode() + b'\r\n')
+    for name, (filename, data) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                     f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode()
+                     + data + b'\r\n')
+    return b''.join(parts) + f'--{boundary}--\r\n'.encode()
+
+
+class MultipartParserTest(unittest.TestCase):
+    def parse(self, body, boundary=b'XyZ', chunk_size=7):
+        files = {}
+
+        def open_file(name, filename):
+            files[name] = (filename, io.BytesIO())
+            return files[name][1]
+
+        parser = us.MultipartParser(io.BytesIO(body), boundary, len(body), chunk_size=chunk_size)
+        fields = parser.parse(open_file)
+        return fields, {k: (fn, buf.getvalue()) for k, (fn, buf) in files.items()}
+
+    def test_fields_and_file_across_chunk_boundaries(self):
+        # El contenido incluye trozos del delimitador para forzar falsos positivos
+        data = os.urandom(5000) + b'\r\n--XyZ'[:-1] + b'\r\n--' + os.urandom(300)
+        body = multipart_body('XyZ', {'folder': 'gba'}, {'file': ('Game (USA).gba', data)})
+        for chunk_size in (1, 7, 64, 65536):
+            fields, files = self.parse(body, chunk_size=chunk_size)
+            self.assertEqual(fields, {'folder': 'gba'})
+            self.assertEqual(files['file'], ('Game (USA).gba', data))
+
+    def test_discarded_file_part(self):
+        body = multipart_body('XyZ', {'a': '1'}, {'file': ('x.bin', b'abc')})
+        parser = us.MultipartParser(io.BytesIO(body), b'XyZ', len(body))
+        self.assertEqual(parser.parse(lambda name, filename: None), {'a': '1'})
+
+    def test_missing_closing_boundary(self):
+        body = multipart_body('XyZ', {'a': '1'}, {})[:-8]
+        with self.assertRaises(us.MultipartError):
+            self.parse(body)
+
+    def test_field_too_large(self):
+        body = multipart_body('XyZ', {'a': 'x' * (us.MultipartParser.FIELD_LIMIT + 1)}, {})
+        with self.assertRaises(us.MultipartError):
+            self.parse(body, chunk_size=4096)
+
+
+class PngTest(TempDirTestCase):
+    def round_trip(self, width, height, rgba, **kwargs):
+        path = os.path.join(self.tmp, 'img.png')
+        us.write_png(path, width, height, rgba, **kwargs)
+        self.assertEqual(us.read_png(path), (width, height, bytearray(rgba)))
+
+    def test_round_trip_every_filter(self):
+        rng = random.Random(1)
+        width, height = 37, 11
+        rgba = bytes(rng.randrange(256) for _ in range(width * height * 4))
+        # write_png solo escribe None, Sub y Up
+        for filter_type in range(3):
+            with self.subTest(filter_type=filter_type):
+                self.round_trip(width, height, rgba, filter_type=filter_type)
+
+    def test_reads_average_and_paeth(self):
+        rng = random.Random(2)
+        width, height, bpp = 13, 6, 4
+        rgba = bytes(rng.randrange(256) for _ in range(width * height * bpp))
+        stride = width * bpp
+        raw = bytearray()
+        prev = bytes(stride)
+        for y in range(height):
+            row = rgba[y * stride:(y + 1) * stride]
+            filter_type = 3 + y % 2
+            raw.append(filter_type)
+            for i in range(stride):
+                a = row[i - bpp] if i >= bpp else 0
+                b = prev[i]
+                c = prev[i - bpp] if i >= bpp else 0
+                if filter_type == 3:
+                    predictor = (a + b) >> 1
+                else:
+                    p = a + b - c
+                    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                    predictor = a if pa <= pb and pa <= pc else b if pb <= pc else c
+                raw.append((row[i] - predictor) & 0xff)
+            prev = row
+        path = os.path.join(self.tmp, 'filtered.png')
+        with open(path, 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n'
+                    + us.png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+                    + us.png_chunk(b'IDAT', zlib.compress(bytes(raw)))
+                    + us.png_chunk(b'IEND', b''))
+        self.assertEqual(us.read_png(path), (width, height, bytearray(rgba)))
+
+    def test_round_trip_palette_and_opaque(self):
+        width, height = 20, 9
+        # Pocos colores con transparencia: se guarda indexada con tRNS
+        colors = [(255, 0, 0, 255), (0, 0, 255, 128), (0, 0, 0, 0)]
+        rgba = bytes(c for i in range(width * height) for c in colors[i % 3])
+        self.round_trip(width, height, rgba)
+        self.round_trip(width, height, rgba, palette=False)
+        # Opaca con muchos colores: RGB sin alfa
+        rgba = bytes(v for i in range(width * height) for v in (i % 256, (i * 7) % 256, 99, 255))
+        self.round_trip(width, height, rgba)
+
+    def test_rejects_non_png(self):
+        path = os.path.join(self.tmp, 'bad.png')
+        with open(path, 'wb') as f:
+            f.write(b'GIF89a' + bytes(40))
+        with self.assertRaises(ValueError):
+            us.read_png(path)
+
+
+class ZipStreamWriterTest(TempDirTestCase):
+    def test_archive_is_readable(self):
+        contents = {
+            'a.gba': os.urandom(100000),
+            'Game (Europe) (En,Fr).gb': b'hello ' * 50000,
+            'vacío.bin': b'',
+        }
+        out = io.BytesIO()
+        writer = us.ZipStreamWriter(out)
+        for i, (name, data) in enumerate(contents.items()):
+            path = os.path.join(self.tmp, f'f{i}')
+            with open(path, 'wb') as f:
+                f.write(data)
+            writer.add_file(path, name, compress=i % 2 == 1)
+        writer.close()
+        self.assertEqual(writer.offset, len(out.getvalue()))
+
+        with zipfile.ZipFile(io.BytesIO(out.getvalue())) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), list(contents))
+            for name, data in contents.items():
+                self.assertEqual(zf.read(name), data)
+            self.assertEqual(zf.getinfo('a.gba').compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zf.getinfo('Game (Europe) (En,Fr).gb').compress_type, zipfile.ZIP_DEFLATED)
+
+
+class RomDatIndexTest(TempDirTestCase):
+    CLRMAMEPRO = '''clrmamepro (
+\tname "Nintendo - Game Boy Advance"
+)
+
+game (
+\tname "Advance Wars (USA)"
+\tserial "AWRE"
+\trom ( name "Advance Wars (USA).gba" size 8388608 crc 7d7b1a0b md5 0 )
+)
+
+game (
+\tname "Advance Wars (USA) (Rev 1)"
+\tserial "AWRE"
+\trom ( name "Advance Wars (USA) (Rev 1).gba" size 8388608 crc 11111111 )
+)
+'''
+
+    LOGIQX = '''<?xml version="1.0"?>
+<datafile>
+  <game name="Tetris (World) (Rev 1)">
+    <rom name="Tetris (World) (Rev 1).gb" size="32768" crc="46DF91AD"/>
+  </game>
+</datafile>
+'''
+
+    def setUp(self):
+        super().setUp()
+        with open(os.path.join(self.tmp, 'Nintendo - Game Boy Advance.dat'), 'w') as f:
+            f.write(self.CLRMAMEPRO)
+        with open(os.path.join(self.tmp, 'Nintendo_-_Game_Boy.dat'), 'w') as f:
+            f.write(self.LOGIQX)
+        self.index = us.RomDatIndex(self.tmp)
+
+    def test_clrmamepro_lookup(self):
+        system = 'Nintendo - Game Boy Advance'
+        self.assertTrue(self.index.has_system(system))
+        self.assertEqual(self.index.lookup(system, {'crc': '7D7B1A0B'}), 'Advance Wars (USA)')
+        # CRC desconocido (parche): se busca por codigo y gana la revision original
+        self.assertEqual(self.index.lookup(system, {'crc': '00000000', 'code': 'AWRE'}),
+                         'Advance Wars (USA)')
+        self.assertIsNone(self.index.lookup(system, {'crc': '00000000', 'code': 'ZZZZ'}))
+
+    def test_logiqx_lookup_with_underscored_file_name(self):
+        self.assertEqual(self.index.lookup('Nintendo - Game Boy', {'crc': '46DF91AD'}),
+                         'Tetris (World) (Rev 1)')
+
+    def test_unknown_or_unsafe_system(self):
+        self.assertFalse(self.index.has_system('Sega - Saturn'))
+        self.assertFalse(self.index.has_system('../Nintendo - Game Boy'))
+
+
+class LibretroNameIndexTest(TempDirTestCase):
+    MANIFEST = '\n'.join([
+        'Named_Boxarts/Super Mario Advance (Europe).png',
+        'Named_Boxarts/Super Mario Advance (USA).png',
+        'Named_Snaps/Mario Kart - Super Circuit (USA).png',
+        'Named_Boxarts/Mario Kart 2 (Japan).png',
+        'Named_Boxarts/Pokemon - Ruby Version (USA, Europe).png',
+        'README.md',
+    ])
+
+    def setUp(self):
+        super().setUp()
+        with open(os.path.join(self.tmp, 'Nintendo - Game Boy Advance.txt'), 'w') as f:
+            f.write(self.MANIFEST)
+        self.index = us.LibretroNameIndex(self.tmp)
+        self.system = 'Nintendo - Game Boy Advance'
+
+    def test_exact_match_prefers_usa(self):
+        self.assertEqual(self.index.resolve(self.system, 'Super Mario Advance (E)'),
+                         ('Super Mario Advance (USA)', 'Named_Boxarts'))
+
+    def test_match_keeps_thumbnail_type(self):
+        self.assertEqual(self.index.resolve(self.system, 'Mario Kart - Super Circuit'),
+                         ('Mario Kart - Super Circuit (USA)', 'Named_Snaps'))
+
+    def test_fuzzy_match(self):
+        self.assertEqual(self.index.resolve(self.system, 'Pokemon Ruby Version'),
+                         ('Pokemon - Ruby Version (USA, Europe)', 'Named_Boxarts'))
+
+    def test_numbers_must_match(self):
+        self.assertIsNone(self.index.resolve(self.system, 'Mario Kart'))
+        self.assertIsNone(self.index.resolve(self.system, 'Mario Kart 3'))
+
+    def test_unknown_system(self):
+        self.assertFalse(self.index.has_system('Sony - PlayStation'))
+        self.assertIsNone(self.index.resolve('Sony - PlayStation', 'Crash Bandicoot'))
+
+
+class UploadSessionTest(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        roms_dir = os.path.join(self.tmp, 'roms')
+        sessions_dir = os.path.join(roms_dir, '.uploads', 'sessions')
+        index = us.RomHashIndex(os.path.join(self.tmp, 'rom_hashes.json'), save_delay=None)
+        for patch in (mock.patch.object(us, 'ROMS_DIR', roms_dir),
+                      mock.patch.object(us, 'UPLOAD_SESSIONS_DIR', sessions_dir),
+                      mock.patch.object(us, 'ROM_DEDUP_MODE', 'off'),
+                      mock.patch.object(us, 'rom_index', index)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.roms_dir = roms_dir
+
+    def test_chunks_out_of_order(self):
+        data = os.urandom(1000)
+        session = us.create_upload_session('gba', 'C:\\roms\\Game.gba', len(data))
+        self.assertEqual(session['filename'], 'Game.gba')
+        sid = session['id']
+
+        session = us.write_upload_chunk(sid, 600, 400, io.BytesIO(data[600:]))
+        self.assertEqual(us.upload_session_view(session)['offset'], 0)
+        session = us.write_upload_chunk(sid, 0, 300, io.BytesIO(data[:300]))
+        view = us.upload_session_view(session)
+        self.assertEqual((view['offset'], view['received']), (300, [[0, 300], [600, 1000]]))
+        with self.assertRaises(ValueError):
+            us.finalize_upload_session(sid)
+
+        session = us.write_upload_chunk(sid, 300, 300, io.BytesIO(data[300:600]))
+        self.assertEqual(us.upload_session_view(session)['offset'], 1000)
+        rom_path, dedup = us.finalize_upload_session(sid)
+        self.assertEqual(rom_path, os.path.join(self.roms_dir, 'gba', 'Game.gba'))
+        with open(rom_path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(dedup['duplicates'], [])
+        with self.assertRaises(KeyError):
+            us.load_upload_session(sid)
+
+    def test_chunk_bounds(self):
+        sid = us.create_upload_session('gba', 'Game.gba', 100)['id']
+        for offset, length in ((-1, 10), (95, 10), (0, 101)):
+            with self.subTest(offset=offset, length=length):
+                with self.assertRaises(ValueError):
+                    us.write_upload_chunk(sid, offset, length, io.BytesIO(bytes(length)))
+        # Cuerpo mas corto que lo anunciado
+        with self.assertRaises(ValueError):
+            us.write_upload_chunk(sid, 0, 50, io.BytesIO(bytes(10)))
+
+    def test_unknown_or_malformed_session_id(self):
+        for sid in ('0' * 32, '../../etc/passwd', ''):
+            with self.assertRaises(KeyError):
+                us.load_upload_session(sid)
+
+    def test_finalize_rechecks_stored_folder(self):
+        session = us.create_upload_session('gba', 'Game.gba', 4)
+        session['folder'] = '../escape'
+        us.save_upload_session(session)
+        us.write_upload_chunk(session['id'], 0, 4, io.BytesIO(b'abcd'))
+        with self.assertRaises(ValueError):
+            us.finalize_upload_session(session['id'])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'escape')))
+
+
+class NameValidationTest(unittest.TestCase):
+    def test_system_names(self):
+        self.assertTrue(us.valid_system_name('Nintendo - Game Boy Advance'))
+        for name in ('', ' ', '.hidden', '../gba', 'a/b', 'a\\b', 'a\0b', None):
+            self.assertFalse(us.valid_system_name(name), name)
+
+    def test_file_names(self):
+        self.assertTrue(us.valid_file_name('Game (USA).gba'))
+        for name in ('', '.', '..', 'a/b.gba', 'a\\b.gba', 'a\0.gba', None):
+            self.assertFalse(us.valid_file_name(name), name)
+
+
+if __name__ == '__main__':
+    unittest.main()
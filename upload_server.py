@@ -5,35 +5,354 @@ Servidor simple para subida de archivos ROM y thumbnails.
 import os
 import sys
 import json
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import urllib.request
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import urllib.parse
+import http.client
 import threading
 import time
 import re
+import select
+import socket
 import zlib
 import struct
+import array
+import base64
+import itertools
+import operator
+import tempfile
+import shutil
+import uuid
+import hashlib
+import heapq
+import mmap
+import xml.etree.ElementTree as ET
+from collections import OrderedDict, deque
 
 # Configuración
-ROMS_DIR = "/roms"
-THUMBNAILS_DIR = "/thumbnails"
+ROMS_DIR = os.environ.get("ROMS_DIR", "/roms")
+THUMBNAILS_DIR = os.environ.get("THUMBNAILS_DIR", "/thumbnails")
+
+# Modo del servidor HTTP: "pool" (workers acotados), "threading" (un hilo por
+# conexion, sin limite) o "single" (un solo hilo, comportamiento original)
+SERVER_MODE = os.environ.get("UPLOAD_SERVER_MODE", "pool")
+SERVER_PORT = int(os.environ.get("UPLOAD_SERVER_PORT", "8080"))
+SERVER_WORKERS = int(os.environ.get("UPLOAD_SERVER_WORKERS", "8"))
+# Peticiones admitidas a la vez (en curso + en cola); el resto recibe 503
+SERVER_MAX_INFLIGHT = int(os.environ.get("UPLOAD_SERVER_MAX_INFLIGHT", "32"))
+
+# Subidas: tamaño de bloque al leer el cuerpo y carpeta temporal (dentro de
+# ROMS_DIR para que el rename final sea atomico)
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_TMP_DIR = os.path.join(ROMS_DIR, ".uploads")
+
+# Subidas reanudables: estado persistido en disco para sobrevivir reinicios
+UPLOAD_SESSIONS_DIR = os.path.join(UPLOAD_TMP_DIR, "sessions")
+UPLOAD_SESSION_CHUNK = 4 * 1024 * 1024
+UPLOAD_SESSION_TTL = int(os.environ.get("UPLOAD_SESSION_TTL", str(7 * 24 * 3600)))
+
+# ROMs duplicadas (mismo sha256): off no las busca, report las indica en la
+# respuesta de la subida y hardlink ademas guarda la copia como enlace duro
+ROM_DEDUP_MODE = os.environ.get("ROM_DEDUP_MODE", "report")
+ROM_HEAD_SIZE = 4096
+
+# Escaneo de thumbnails: ROMs procesadas en paralelo y maximo de peticiones
+# simultaneas contra un mismo host remoto
+SCAN_WORKERS = int(os.environ.get("THUMB_SCAN_WORKERS", "8"))
+SCAN_HOST_CONCURRENCY = int(os.environ.get("THUMB_HOST_CONCURRENCY", "4"))
+# Trabajos de escaneo terminados que se recuerdan en /thumbs/jobs
+SCAN_JOBS_KEEP = 50
+
+# Stream de eventos del escaneo (SSE): comentario de keep-alive cada
+# EVENTS_HEARTBEAT segundos; pasados EVENTS_MAX_AGE se cierra y el navegador
+# reconecta solo, asi un cliente olvidado no retiene un worker para siempre
+EVENTS_HEARTBEAT = 15
+EVENTS_MAX_AGE = 300
+EVENTS_MIN_INTERVAL = 0.1
+# Cada cuantos segundos se comprueba, mientras no hay eventos, si el navegador
+# cerro la conexion (asi una pestaña cerrada libera su plaza enseguida)
+EVENTS_PEER_CHECK = 1.0
+# Cada stream ocupa un worker mientras dura: por encima de EVENTS_MAX_STREAMS
+# se responde 503 y el navegador pasa a sondear /thumbs/status
+EVENTS_MAX_STREAMS = int(os.environ.get("EVENTS_MAX_STREAMS", str(max(1, SERVER_WORKERS // 2))))
+# Busquedas de /thumbs/resolve a la vez (cada una ocupa un worker); el resto
+# recibe 503 y el navegador reintenta
+RESOLVE_MAX_CONCURRENT = int(os.environ.get("RESOLVE_MAX_CONCURRENT", str(max(1, SERVER_WORKERS // 4))))
+
+# Procesos para generar placeholders (CPU pura, fuera del GIL del servidor);
+# 0 los genera en el propio hilo del escaneo
+PLACEHOLDER_PROCESSES = int(os.environ.get("PLACEHOLDER_PROCESSES", str(min(4, os.cpu_count() or 1))))
+
+# Miniaturas para el grid de la web (lado mayor en px), junto a cada thumbnail
+# en <consola>/.sizes/<tamaño>/
+THUMB_GRID_SIZES = [int(s) for s in os.environ.get("THUMB_GRID_SIZES", "180,360").split(',') if s.strip()]
+THUMB_SIZES_DIR = ".sizes"
+
+# Atlas (sprite sheets) de miniaturas: una imagen por pagina del grid
+ATLAS_MAX_ITEMS = 200
+ATLAS_COLUMNS = 10
+ATLAS_CACHE_MAX = int(os.environ.get("ATLAS_CACHE_MAX", "200"))
+# Locks para no generar el mismo atlas dos veces a la vez (por hash de la clave)
+ATLAS_LOCK_STRIPES = 64
+
+# Catalogo de la biblioteca: se revisa el disco como mucho cada
+# CATALOG_MAX_AGE segundos (antes si cambia el mtime de la carpeta)
+CATALOG_MAX_AGE = int(os.environ.get("CATALOG_MAX_AGE", "60"))
+CATALOG_PAGE_SIZE = 500
+
+# Packs ZIP generados al vuelo: se lee y se envia en bloques de ZIP_CHUNK_SIZE
+# y no se recomprimen los formatos que ya vienen comprimidos
+ZIP_CHUNK_SIZE = 256 * 1024
+ZIP_DEFLATE_LEVEL = int(os.environ.get("ZIP_DEFLATE_LEVEL", "6"))
+ZIP_STORED_EXTENSIONS = {'.zip', '.7z', '.rar', '.gz', '.chd', '.cso', '.rvz', '.pbp', '.png', '.jpg'}
+# Descargas ZIP a la vez (cada una ocupa un worker hasta terminar); el resto
+# recibe 503 con Retry-After
+ZIP_MAX_CONCURRENT = int(os.environ.get("ZIP_MAX_CONCURRENT", str(max(1, SERVER_WORKERS // 4))))
+
+# Conexiones keep-alive reutilizadas por host para las descargas remotas
+HTTP_POOL_MAX_IDLE = int(os.environ.get("HTTP_POOL_MAX_IDLE", "8"))
+HTTP_POOL_IDLE_TIMEOUT = int(os.environ.get("HTTP_POOL_IDLE_TIMEOUT", "30"))
+
+# Estado persistente del servidor (caches, indices...). Va dentro de
+# THUMBNAILS_DIR porque es el unico volumen rw ademas de las ROMs
+CACHE_DIR = os.path.join(THUMBNAILS_DIR, ".cache")
+ATLAS_CACHE_DIR = os.path.join(CACHE_DIR, "atlas")
+ROM_INDEX_PATH = os.path.join(CACHE_DIR, "rom_hashes.json")
+# Segundos que espera el indice de hashes antes de escribir sus cambios, para
+# agrupar en una sola escritura las subidas seguidas
+ROM_INDEX_SAVE_DELAY = 5
+
+# Cache de busquedas en libretro: los 404 se recuerdan LOOKUP_CACHE_TTL segundos
+LOOKUP_CACHE_TTL = int(os.environ.get("LOOKUP_CACHE_TTL", str(30 * 24 * 3600)))
+LOOKUP_CACHE_MAX_ENTRIES = int(os.environ.get("LOOKUP_CACHE_MAX_ENTRIES", "200000"))
+
+# Indice local de nombres disponibles en libretro-thumbnails. Por cada sistema
+# se admite una carpeta (clon de libretro-thumbnails/<Sistema>) o un manifiesto
+# <Sistema>.txt con una ruta por linea ("Named_Boxarts/Nombre.png")
+LIBRETRO_INDEX_DIR = os.environ.get("LIBRETRO_INDEX_DIR", os.path.join(CACHE_DIR, "libretro_index"))
+THUMB_TYPES = ["Named_Boxarts", "Named_Snaps", "Named_Titles"]
+# Servidor de thumbnails de libretro (se puede cambiar por un espejo)
+LIBRETRO_THUMBS_URL = os.environ.get("LIBRETRO_THUMBS_URL", "https://thumbnails.libretro.com")
+
+# DATs No-Intro locales (<Sistema>.dat, formato clrmamepro o XML). Si hay DAT
+# del sistema, las ROMs se identifican por CRC32 (o codigo de juego GBA) y se
+# descarga directamente el nombre canonico de libretro
+ROM_DAT_DIR = os.environ.get("ROM_DAT_DIR", os.path.join(CACHE_DIR, "dats"))
+ROM_IDS_PATH = os.path.join(CACHE_DIR, "rom_ids.json")
+# Aciertos por sistema de cada patron de nombre y tipo de thumbnail: los
+# nombres se prueban de mas a menos probable y, si la probabilidad estimada
+# de un tipo es menor que LIBRETRO_HEAD_BELOW, se comprueba antes con HEAD
+CANDIDATE_STATS_PATH = os.path.join(CACHE_DIR, "candidate_stats.json")
+LIBRETRO_HEAD_BELOW = float(os.environ.get("LIBRETRO_HEAD_BELOW", "0.5"))
+
+
+class LogRing:
+    """Ultimas lineas de log con un numero de secuencia creciente.
+
+    Añadir es O(1) y seguro entre hilos; since(seq) devuelve solo las lineas
+    posteriores a seq para que los clientes pidan lo nuevo en cada consulta.
+    """
+
+    def __init__(self, size=1000):
+        self.lines = deque(maxlen=size)
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def append(self, msg):
+        with self.lock:
+            self.seq += 1
+            self.lines.append(msg)
+            return self.seq
+
+    def since(self, seq=None, limit=None):
+        """(lineas, ultima secuencia); sin seq devuelve las ultimas limit"""
+        with self.lock:
+            # Una secuencia mayor que la actual viene de antes de un reinicio
+            if seq is not None and seq > self.seq:
+                seq = 0
+            count = len(self.lines) if seq is None else max(0, min(self.seq - seq, len(self.lines)))
+            if limit is not None:
+                count = min(count, limit)
+            lines = list(itertools.islice(reversed(self.lines), count))
+            lines.reverse()
+            return lines, self.seq
+
+
+class ChangeNotifier:
+    """Contador de cambios que despierta a los hilos que esperan uno nuevo"""
+
+    def __init__(self):
+        self.version = 0
+        self.cond = threading.Condition()
+
+    def notify(self):
+        with self.cond:
+            self.version += 1
+            self.cond.notify_all()
+
+    def wait(self, version, timeout):
+        """Esperar hasta que haya cambios posteriores a version; devuelve la actual"""
+        with self.cond:
+            if self.version == version:
+                self.cond.wait(timeout)
+            return self.version
+
 
 # Buffer de logs
-log_buffer = []
-thumb_log_buffer = []
-
-thumb_scan_state = {
-    "running": False,
-    "total": 0,
-    "processed": 0,
-    "found": 0,
-    "generated": 0,
-    "failed": 0,
-    "current": "",
-    "started_at": None,
-    "finished_at": None
-}
-thumb_scan_lock = threading.Lock()
+log_buffer = LogRing()
+thumb_log_buffer = LogRing()
+
+# Protege los trabajos de escaneo y la cola de ScanScheduler
+thumb_scan_lock = threading.Condition()
+# Avisa de nuevas lineas en thumb_log_buffer y cambios en los escaneos
+thumb_events = ChangeNotifier()
+
+
+# Metricas en formato de texto de Prometheus (GET /metrics)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+THROUGHPUT_BUCKETS = (64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6, 1e9)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {} if labels else {(): 0}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """Histograma acumulado por etiquetas (buckets fijos, como Prometheus)"""
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {} if labels else {(): [[0] * len(buckets), 0, 0.0]}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.series.items())
+        for label_values, (counts, count, total) in items:
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, [('le', f'{bound:g}')])} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+class Gauge:
+    """Valor que se calcula al pedir las metricas"""
+
+    def __init__(self, name, help_text, func):
+        self.name = name
+        self.help = help_text
+        self.func = func
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.func()}"]
+
+
+def _scan_queue_depth():
+    with thumb_scan_lock:
+        return len(scan_scheduler.heap)
+
+
+metrics_requests = Counter("upload_server_requests_total", "HTTP requests handled",
+                           ("method", "route", "status"))
+metrics_request_seconds = Histogram("upload_server_request_duration_seconds", "HTTP request latency",
+                                    ("method", "route"))
+metrics_rejected = Counter("upload_server_rejected_total", "Connections answered 503 because the server was saturated")
+metrics_upload_bytes = Counter("upload_server_upload_bytes_total", "ROM bytes received", ("kind",))
+metrics_upload_rate = Histogram("upload_server_upload_bytes_per_second", "Throughput of each ROM upload or chunk",
+                                ("kind",), THROUGHPUT_BUCKETS)
+metrics_probe_seconds = Histogram("upload_server_libretro_probe_seconds", "Latency of each libretro thumbnail probe",
+                                  ("type", "outcome"))
+metrics_thumb_write_seconds = Histogram("upload_server_thumbnail_write_seconds", "Time to write a downloaded thumbnail")
+metrics_placeholder_seconds = Histogram("upload_server_placeholder_render_seconds",
+                                        "Placeholder render time, including the wait for the process pool")
+metrics_resolve = Counter("upload_server_thumb_resolve_total",
+                          "On-demand thumbnail resolutions by result (pending = already in flight, busy = no free slot)",
+                          ("source",))
+metrics_sizes_seconds = Histogram("upload_server_thumb_sizes_render_seconds", "Time to render the grid-size derivatives")
+METRICS = [
+    metrics_requests, metrics_request_seconds, metrics_rejected,
+    metrics_upload_bytes, metrics_upload_rate,
+    metrics_probe_seconds, metrics_thumb_write_seconds, metrics_placeholder_seconds, metrics_sizes_seconds,
+    metrics_resolve,
+    Gauge("upload_server_scan_queue_depth", "Scan tasks waiting for a worker", _scan_queue_depth),
+]
+
+
+def record_upload(kind, size, seconds):
+    metrics_upload_bytes.inc(kind, amount=size)
+    if seconds > 0:
+        metrics_upload_rate.observe(size / seconds, kind)
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Rutas con las que se etiquetan las peticiones (sin ids ni nombres de
+# fichero, para no crear una serie por URL)
+METRIC_ROUTES = (
+    '/upload/session', '/upload/thumbnail_base64', '/upload/thumbnail', '/upload/rom',
+    '/library', '/zip', '/thumbs/grid', '/thumbs/atlas', '/thumbs/status', '/thumbs/events',
+    '/thumbs/logs', '/thumbs/scan', '/thumbs/jobs', '/thumbs/resolve', '/logs', '/metrics',
+)
+
+
+def metric_route(path):
+    path = path.split('?', 1)[0]
+    for route in METRIC_ROUTES:
+        if path == route or path.startswith(route + '/'):
+            return route
+    return 'other'
+
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
 
 LIBRETRO_MAP = {
     "gb": "Nintendo - Game Boy",
@@ -50,8 +369,6 @@ ROM_EXTENSIONS = {
 def log_message(msg):
     """Añadir mensaje al log"""
     log_buffer.append(msg)
-    if len(log_buffer) > 1000:
-        log_buffer.pop(0)
     print(msg)
     sys.stdout.flush()
 
@@ -59,8 +376,7 @@ def log_message(msg):
 
 def log_thumb(msg):
     thumb_log_buffer.append(msg)
-    if len(thumb_log_buffer) > 1000:
-        thumb_log_buffer.pop(0)
+    thumb_events.notify()
     print(msg)
     sys.stdout.flush()
 
@@ -82,143 +398,1146 @@ def clean_game_name(name: str) -> str:
     return clean
 
 
-def name_variations(clean: str):
-    variations = [clean]
+def name_candidates(clean: str):
+    """Pares (patron, nombre) a probar en libretro, en el orden por defecto"""
+    variations = [("clean", clean)]
     if clean.lower().startswith('the '):
-        variations.append(clean[4:])
-        variations.append(f"{clean[4:]}, The")
+        variations.append(("no_article", clean[4:]))
+        variations.append(("article_suffix", f"{clean[4:]}, The"))
     if '&' in clean:
-        variations.append(clean.replace('&', 'and'))
+        variations.append(("and_word", clean.replace('&', 'and')))
     if ' and ' in clean:
-        variations.append(clean.replace(' and ', ' & '))
+        variations.append(("and_symbol", clean.replace(' and ', ' & ')))
     # únicos
     seen = set()
     out = []
-    for v in variations:
+    for pattern, v in variations:
         if v and v not in seen:
             seen.add(v)
-            out.append(v)
+            out.append((pattern, v))
     return out
 
 
-def try_download_libretro(system, game_name, output_path):
-    base_url = f"https://thumbnails.libretro.com/{urllib.parse.quote(system)}"
-    types = ["Named_Boxarts", "Named_Snaps", "Named_Titles"]
+def name_variations(clean: str):
+    return [name for _, name in name_candidates(clean)]
+
+
+class HTTPConnectionPool:
+    """Pool de conexiones HTTP(S) keep-alive compartido entre hilos.
+
+    Guarda hasta max_idle conexiones libres por host y cierra las que llevan
+    mas de idle_timeout segundos sin usarse. Cada peticion lee la respuesta
+    entera, asi que la conexion vuelve al pool en cuanto termina.
+    """
+
+    REDIRECTS = {301, 302, 303, 307, 308}
+
+    def __init__(self, max_idle=HTTP_POOL_MAX_IDLE, idle_timeout=HTTP_POOL_IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def _acquire(self, key, timeout):
+        now = time.time()
+        with self.lock:
+            conns = self.idle.get(key, [])
+            while conns:
+                conn, last_used = conns.pop()
+                if now - last_used < self.idle_timeout:
+                    conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=timeout), False
+        if scheme == 'http':
+            return http.client.HTTPConnection(host, port, timeout=timeout), False
+        raise ValueError(f"Unsupported URL scheme: {scheme}")
+
+    def _release(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append((conn, time.time()))
+                return
+        conn.close()
+
+    def _request(self, key, method, path, headers, timeout):
+        conn, reused = self._acquire(key, timeout)
+        try:
+            conn.request(method, path, headers=headers)
+            resp = conn.getresponse()
+            body = resp.read()
+        except (ConnectionError, http.client.HTTPException):
+            conn.close()
+            # El servidor pudo cerrar una conexion reutilizada: un reintento
+            # con conexion nueva
+            if reused:
+                return self._request(key, method, path, headers, timeout)
+            raise
+        except Exception:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+        return resp.status, body, resp.headers
+
+    def fetch(self, url, method='GET', headers=None, timeout=20, max_redirects=5):
+        """Hacer una peticion y devolver (status, body, headers)"""
+        request_headers = {'User-Agent': 'Mozilla/5.0'}
+        request_headers.update(headers or {})
+        for _ in range(max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port)
+            path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+            status, body, resp_headers = self._request(key, method, path, request_headers, timeout)
+            location = resp_headers.get('Location')
+            if status not in self.REDIRECTS or not location:
+                return status, body, resp_headers
+            url = urllib.parse.urljoin(url, location)
+            if status == 303:
+                method = 'GET'
+        raise http.client.HTTPException(f"Too many redirects: {url}")
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn, _ in conns:
+                    conn.close()
+            self.idle.clear()
+
+
+http_pool = HTTPConnectionPool()
+
+
+def host_slot(url):
+    """Semaforo que limita las peticiones concurrentes al host de url"""
+    host = urllib.parse.urlsplit(url).netloc
+    with host_semaphores_lock:
+        sem = host_semaphores.get(host)
+        if sem is None:
+            sem = host_semaphores[host] = threading.BoundedSemaphore(SCAN_HOST_CONCURRENCY)
+    return sem
+
+
+class LookupCache:
+    """Cache en disco de resultados de busqueda de thumbnails remotos.
+
+    Guarda "hit" o "miss" por (sistema, nombre candidato, tipo de thumbnail)
+    para que los reescaneos no vuelvan a pedir nombres que ya dieron 404.
+    Las entradas caducan tras ttl segundos y, si se supera max_entries, se
+    descartan las mas antiguas.
+    """
+
+    FLUSH_EVERY = 500
+
+    def __init__(self, path, ttl=LOOKUP_CACHE_TTL, max_entries=LOOKUP_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.dirty = 0
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            now = time.time()
+            for key, (outcome, stamp) in sorted(data.items(), key=lambda kv: kv[1][1]):
+                if now - stamp < ttl:
+                    self.entries[key] = [outcome, stamp]
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def key(system, name, thumb_type):
+        return f"{system}\t{thumb_type}\t{name}"
+
+    def get(self, system, name, thumb_type):
+        key = self.key(system, name, thumb_type)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[1] >= self.ttl:
+                del self.entries[key]
+                return None
+            return entry[0]
+
+    def is_miss(self, system, name, thumb_type):
+        return self.get(system, name, thumb_type) == "miss"
+
+    def put(self, system, name, thumb_type, outcome):
+        key = self.key(system, name, thumb_type)
+        with self.lock:
+            self.entries[key] = [outcome, time.time()]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty += 1
+            flush = self.dirty >= self.FLUSH_EVERY
+        if flush:
+            self.save()
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                snapshot = dict(self.entries)
+                self.dirty = 0
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, self.path)
+
+
+lookup_cache = None
+lookup_cache_lock = threading.Lock()
+
+
+def get_lookup_cache():
+    global lookup_cache
+    with lookup_cache_lock:
+        if lookup_cache is None:
+            lookup_cache = LookupCache(os.path.join(CACHE_DIR, "lookup_cache.json"))
+        return lookup_cache
+
+
+def _index_key(name):
+    """Clave normalizada para comparar nombres de ROM con nombres de libretro"""
+    # clean_game_name espera una extension; se añade una ficticia para no
+    # perder texto tras el ultimo punto ("Super Mario Bros. 3")
+    clean = clean_game_name(name + '.x').lower().replace('&', ' and ')
+    tokens = [t for t in re.sub(r'[^a-z0-9]+', ' ', clean).split() if t != 'the']
+    return ' '.join(tokens)
+
+
+def _region_rank(name):
+    for rank, region in enumerate(('(USA', '(World', '(Europe')):
+        if region in name:
+            return rank
+    return 3
+
+
+def valid_system_name(name):
+    """Nombre de sistema o consola que se puede usar como nombre de fichero"""
+    return (isinstance(name, str) and bool(name.strip()) and not name.startswith('.')
+            and not any(c in name for c in ('/', '\\', '\0')) and '..' not in name)
+
+
+def valid_file_name(name):
+    """Nombre de fichero sin separadores que no apunta a la carpeta ni a su padre"""
+    return (isinstance(name, str) and bool(name.strip()) and name not in ('.', '..')
+            and not any(c in name for c in ('/', '\\', '\0')))
+
+
+def system_path(base_dir, name):
+    """base_dir/name, o None si name no es valido o la ruta sale de base_dir"""
+    if not valid_system_name(name):
+        return None
+    base = os.path.abspath(base_dir)
+    path = os.path.abspath(os.path.join(base, name))
+    return path if os.path.dirname(path) == base else None
+
+
+class LibretroNameIndex:
+    """Indice en memoria de los thumbnails disponibles por sistema.
+
+    Permite resolver un nombre de ROM al nombre exacto de libretro sin hacer
+    peticiones: primero por clave normalizada y, si no hay coincidencia, por
+    similitud de tokens. Si un sistema no tiene indice, has_system() devuelve
+    False y se sigue probando a ciegas contra el servidor.
+    """
+
+    FUZZY_THRESHOLD = 0.8
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.lock = threading.Lock()
+        self.systems = {}
+
+    def _source(self, system):
+        for name in (system, system.replace(' ', '_')):
+            for path in (system_path(self.base_dir, name), system_path(self.base_dir, name + '.txt')):
+                if path and os.path.exists(path):
+                    return path
+        return None
+
+    def _read_source(self, path):
+        if os.path.isdir(path):
+            for thumb_type in THUMB_TYPES:
+                type_dir = os.path.join(path, thumb_type)
+                if not os.path.isdir(type_dir):
+                    continue
+                for entry in os.scandir(type_dir):
+                    if entry.name.lower().endswith('.png'):
+                        yield thumb_type, entry.name[:-4]
+        else:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line.lower().endswith('.png'):
+                        continue
+                    thumb_type, _, name = line.rpartition('/')
+                    thumb_type = thumb_type.rsplit('/', 1)[-1] or THUMB_TYPES[0]
+                    if thumb_type in THUMB_TYPES:
+                        yield thumb_type, name[:-4]
+
+    def _load(self, system):
+        path = self._source(system)
+        if not path:
+            return None
+        mtime = os.stat(path).st_mtime
+        cached = self.systems.get(system)
+        if cached and cached['path'] == path and cached['mtime'] == mtime:
+            return cached
+        exact = {}
+        for thumb_type, name in self._read_source(path):
+            key = _index_key(name)
+            if key:
+                exact.setdefault(key, []).append((THUMB_TYPES.index(thumb_type), _region_rank(name), name, thumb_type))
+        tokens = {}
+        for key, entries in exact.items():
+            entries.sort()
+            for token in key.split():
+                tokens.setdefault(token, set()).add(key)
+        loaded = {'path': path, 'mtime': mtime, 'exact': exact, 'tokens': tokens}
+        self.systems[system] = loaded
+        log_thumb(f"[INDEX] {system}: {len(exact)} names loaded from {path}")
+        return loaded
+
+    def has_system(self, system):
+        with self.lock:
+            return self._load(system) is not None
+
+    def resolve(self, system, name):
+        """Devolver (nombre_libretro, tipo) o None si no hay coincidencia"""
+        with self.lock:
+            index = self._load(system)
+        if not index:
+            return None
+        key = _index_key(name)
+        if not key:
+            return None
+        entries = index['exact'].get(key)
+        if entries:
+            return entries[0][2], entries[0][3]
+
+        query = set(key.split())
+        digits = {t for t in query if t.isdigit()}
+        candidates = set()
+        for token in query:
+            candidates |= index['tokens'].get(token, set())
+        best = None
+        for candidate in candidates:
+            tokens = set(candidate.split())
+            # "Mario Kart" no debe resolver a "Mario Kart 2"
+            if {t for t in tokens if t.isdigit()} != digits:
+                continue
+            score = 2 * len(query & tokens) / (len(query) + len(tokens))
+            if score >= self.FUZZY_THRESHOLD and (best is None or score > best[0]):
+                best = (score, candidate)
+        if not best:
+            return None
+        entry = index['exact'][best[1]][0]
+        return entry[2], entry[3]
+
+
+libretro_index = LibretroNameIndex(LIBRETRO_INDEX_DIR)
+
+
+class CandidateStats:
+    """Aciertos y pruebas por (sistema, tipo de candidato, candidato).
+
+    Los candidatos son patrones de nombre ("pattern"), que order() ordena
+    por tasa de acierto observada con el orden declarado como desempate, o
+    tipos de thumbnail ("type"), que mantienen su orden de preferencia y
+    solo usan rate() para decidir si merece la pena un HEAD antes del GET. Los
+    contadores se reducen a la mitad al pasar de DECAY_AT pruebas para que
+    el orden siga los cambios del servidor.
+    """
+
+    DECAY_AT = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = None
+        self.dirty = False
+
+    def _load(self):
+        if self.entries is None:
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+        return self.entries
+
+    @staticmethod
+    def key(system, kind, candidate):
+        return f"{system}\t{kind}\t{candidate}"
+
+    def rate(self, system, kind, candidate):
+        """Probabilidad de acierto estimada (1/2 sin datos)"""
+        with self.lock:
+            hits, tries = self._load().get(self.key(system, kind, candidate), (0, 0))
+        return (hits + 1) / (tries + 2)
+
+    def order(self, system, kind, candidates, key=lambda c: c):
+        rates = {key(c): self.rate(system, kind, key(c)) for c in candidates}
+        return sorted(candidates, key=lambda c: -rates[key(c)])
+
+    def record(self, system, kind, candidate, hit):
+        key = self.key(system, kind, candidate)
+        with self.lock:
+            entries = self._load()
+            hits, tries = entries.get(key, (0, 0))
+            hits, tries = hits + bool(hit), tries + 1
+            if tries > self.DECAY_AT:
+                hits, tries = hits / 2, tries / 2
+            entries[key] = [hits, tries]
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            snapshot = dict(self.entries)
+            self.dirty = False
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, self.path)
+
+
+candidate_stats = CandidateStats(CANDIDATE_STATS_PATH)
+
+
+def probe_url(url, likely, timeout=20):
+    """Pedir url; si no es probable que exista se comprueba antes con HEAD.
+
+    Asi los fallos no descargan nada y solo se baja el cuerpo del candidato
+    que existe. Devuelve (status, body).
+    """
+    if not likely:
+        status, _, _ = http_pool.fetch(url, method='HEAD', timeout=timeout)
+        # 405/501: el servidor no admite HEAD, se sigue con GET
+        if status not in (200, 405, 501):
+            return status, b''
+    status, body, _ = http_pool.fetch(url, timeout=timeout)
+    return status, body
+
+
+def try_download_libretro(system, game_name, output_path, types=None, stats=None):
+    """Descargar el thumbnail de game_name probando los tipos en orden.
+
+    Devuelve True si se descargo, False si el servidor respondio 404 a todo
+    lo que se pregunto y None si no hubo respuesta definitiva (todo venia
+    de 404 recordados, o hubo errores de red o 5xx).
+    """
+    base_url = f"{LIBRETRO_THUMBS_URL}/{urllib.parse.quote(system)}"
+    stats = stats or candidate_stats
+    types = types or THUMB_TYPES
+    cache = get_lookup_cache()
+    answered = False
+    failed = False
     for thumb_type in types:
+        if cache.is_miss(system, game_name, thumb_type):
+            continue
         encoded = urllib.parse.quote(game_name + '.png')
         url = f"{base_url}/{thumb_type}/{encoded}"
+        # Un tipo ya resuelto por el indice o el DAT, o que ya acerto, se pide directamente
+        likely = (len(types) == 1 or cache.get(system, game_name, thumb_type) == "hit"
+                  or stats.rate(system, "type", thumb_type) >= LIBRETRO_HEAD_BELOW)
+        started = time.monotonic()
         try:
-            req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-            with urllib.request.urlopen(req, timeout=20) as resp:
-                if resp.status == 200:
-                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                    with open(output_path, 'wb') as f:
-                        f.write(resp.read())
-                    return True
+            with host_slot(url):
+                # Sin contar la espera por el limite de conexiones al host
+                started = time.monotonic()
+                status, body = probe_url(url, likely)
         except Exception:
+            metrics_probe_seconds.observe(time.monotonic() - started, thumb_type, "error")
+            failed = True
             continue
-    return False
+        outcome = {200: "hit", 404: "miss"}.get(status, "error")
+        metrics_probe_seconds.observe(time.monotonic() - started, thumb_type, outcome)
+        if status in (200, 404):
+            stats.record(system, "type", thumb_type, status == 200)
+        if status == 200:
+            started = time.monotonic()
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            with open(output_path, 'wb') as f:
+                f.write(body)
+            metrics_thumb_write_seconds.observe(time.monotonic() - started)
+            cache.put(system, game_name, thumb_type, "hit")
+            return True
+        # Solo un 404 es una respuesta definitiva; errores de red o 5xx
+        # se reintentan en el siguiente escaneo
+        if status == 404:
+            cache.put(system, game_name, thumb_type, "miss")
+            answered = True
+        else:
+            failed = True
+    return False if answered and not failed else None
+
+
+# Bytes del principio de la ROM que necesita read_rom_header
+ROM_HEADER_SIZE = 0x150
+
+
+def read_rom_header(data):
+    """Plataforma, titulo y codigo de juego de la cabecera de un cartucho GB/GBC/GBA"""
+    def text(raw):
+        return raw.split(b'\0', 1)[0].decode('ascii', 'replace').strip()
+
+    # GBA: valor fijo 0x96 en 0xB2, titulo en 0xA0 y codigo de juego en 0xAC
+    if len(data) >= 0xC0 and data[0xB2] == 0x96:
+        code = text(data[0xAC:0xB0])
+        return 'gba', text(data[0xA0:0xAC]), code if re.fullmatch(r'[A-Z0-9]{4}', code) else None
+    # GB/GBC: logo de Nintendo en 0x104; el flag CGB (0x143) ocupa el ultimo
+    # byte del titulo en los cartuchos de Color
+    if len(data) >= 0x150 and data[0x104:0x108] == b'\xce\xed\x66\x66':
+        if data[0x143] in (0x80, 0xC0):
+            return 'gbc', text(data[0x134:0x143]), None
+        return 'gb', text(data[0x134:0x144]), None
+    return None
+
+
+def _rom_crc32(data, cartridge=False):
+    """CRC32 como en los DATs No-Intro (sin cabeceras iNES ni de copiador SNES)"""
+    # Cada vista se libera aunque haya una excepcion: con vistas vivas el
+    # mmap del llamador no se puede cerrar (BufferError)
+    with memoryview(data) as view:
+        skip = 0
+        if view[:4] == b'NES\x1a':
+            skip = 16
+        elif not cartridge and len(view) % 1024 == 512:
+            skip = 512
+        crc = 0
+        for start in range(skip, len(view), 1024 * 1024):
+            with view[start:start + 1024 * 1024] as chunk:
+                crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+class RomIdCache:
+    """Identificacion de ROMs en disco: ruta -> [tamaño, mtime_ns, crc32, plataforma, titulo, codigo].
+
+    La ROM se lee una sola vez (con mmap) y la entrada vale mientras el
+    fichero conserve tamaño y mtime.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = None
+        self.dirty = False
+
+    def _load(self):
+        if self.entries is None:
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+        return self.entries
+
+    def identify(self, path):
+        """{'crc', 'platform', 'title', 'code'} de una ROM; None si no existe"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stat = [st.st_size, st.st_mtime_ns]
+        with self.lock:
+            entry = self._load().get(path)
+        if not entry or entry[:2] != stat:
+            header = None
+            crc = 0
+            if st.st_size:
+                with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    header = read_rom_header(data)
+                    crc = _rom_crc32(data, header is not None)
+            entry = stat + [f"{crc:08X}"] + list(header or (None, None, None))
+            with self.lock:
+                self.entries[path] = entry
+                self.dirty = True
+        return {'crc': entry[2], 'platform': entry[3], 'title': entry[4], 'code': entry[5]}
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            for path in [path for path in self.entries if not os.path.exists(path)]:
+                del self.entries[path]
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+
+def _read_clrmamepro(path):
+    """Juegos de un DAT clrmamepro como (nombre, serial, [rom, ...])"""
+    with open(path, encoding='utf-8', errors='replace') as f:
+        tokens = re.findall(r'"[^"]*"|[()]|[^\s()"]+', f.read())
+    stack = []
+    key = None
+    for token in tokens:
+        if token == '(':
+            stack.append({'tag': key})
+            key = None
+        elif token == ')':
+            block = stack.pop() if stack else {}
+            if block.get('tag') == 'rom' and stack:
+                stack[-1].setdefault('roms', []).append(block)
+            elif block.get('tag') in ('game', 'machine') and 'name' in block:
+                yield block['name'], block.get('serial'), block.get('roms', [])
+        elif key is None:
+            key = token
+        else:
+            if stack:
+                stack[-1][key] = token.strip('"')
+            key = None
+
+
+def _read_logiqx(path):
+    """Juegos de un DAT XML (Logiqx) como (nombre, serial, [rom, ...])"""
+    for _, elem in ET.iterparse(path):
+        if elem.tag in ('game', 'machine'):
+            serial = elem.findtext('serial')
+            yield elem.get('name'), serial, [dict(rom.attrib) for rom in elem.iter('rom')]
+            elem.clear()
+
+
+def libretro_thumb_name(name):
+    """Nombre de fichero que usa libretro-thumbnails para un juego del DAT"""
+    return re.sub(r'[&*/:`<>?\\|"]', '_', name)
+
+
+class RomDatIndex:
+    """Indice CRC32 -> nombre canonico construido desde los DATs locales.
+
+    Los DATs de No-Intro (p. ej. libretro-database/metadat/no-intro) usan los
+    mismos nombres que libretro-thumbnails. Se admite <Sistema>.dat con
+    espacios o guiones bajos, y se recarga si el fichero cambia.
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.lock = threading.Lock()
+        self.systems = {}
+
+    def _source(self, system):
+        for name in (system, system.replace(' ', '_'), system.replace('_', ' ')):
+            for ext in ('.dat', '.xml'):
+                path = system_path(self.base_dir, name + ext)
+                if path and os.path.isfile(path):
+                    return path
+        return None
+
+    def _load(self, system):
+        path = self._source(system)
+        if not path:
+            return None
+        mtime = os.stat(path).st_mtime
+        cached = self.systems.get(system)
+        if cached and cached['path'] == path and cached['mtime'] == mtime:
+            return cached
+        with open(path, 'rb') as f:
+            xml = f.read(256).lstrip().startswith(b'<')
+        by_crc = {}
+        by_serial = {}
+        try:
+            for name, serial, roms in (_read_logiqx if xml else _read_clrmamepro)(path):
+                for rom in roms:
+                    if rom.get('crc'):
+                        by_crc.setdefault(rom['crc'].upper(), name)
+                    serial = serial or rom.get('serial')
+                if serial:
+                    by_serial.setdefault(serial.upper(), []).append(name)
+        except (ET.ParseError, UnicodeError) as e:
+            log_thumb(f"[DAT] {system}: could not read {path} ({e})")
+        # Con varias revisiones del mismo codigo se prefiere la original
+        for names in by_serial.values():
+            names.sort(key=lambda n: (len(n), n))
+        loaded = {'path': path, 'mtime': mtime, 'crc': by_crc, 'serial': by_serial}
+        self.systems[system] = loaded
+        log_thumb(f"[DAT] {system}: {len(by_crc)} ROMs loaded from {path}")
+        return loaded
+
+    def has_system(self, system):
+        with self.lock:
+            return self._load(system) is not None
+
+    def lookup(self, system, rom_id):
+        """Nombre del juego en el DAT: por CRC32 y, si no, por codigo GBA"""
+        with self.lock:
+            index = self._load(system)
+        if not index:
+            return None
+        if rom_id['crc'] in index['crc']:
+            return index['crc'][rom_id['crc']]
+        # Traducciones y parches cambian el CRC pero conservan el codigo
+        if rom_id.get('code') and index['serial'].get(rom_id['code']):
+            return index['serial'][rom_id['code']][0]
+        return None
+
+
+def identify_libretro_name(path, system, ids, dats):
+    """(sistema, nombre libretro) de una ROM segun su DAT, o None.
+
+    Se busca en el DAT del sistema de la carpeta y en el que indica la
+    cabecera (un .gb en gbc/ aparece en el DAT de Game Boy).
+    """
+    if not system:
+        return None
+    underscored = ' ' not in system
+    header_systems = {s.replace(' ', '_') if underscored else s: p for p, s in LIBRETRO_MAP.items()}
+    if not dats.has_system(system):
+        # Sin DAT propio solo puede servir el de la cabecera, y solo las
+        # carpetas GB/GBC/GBA la tienen: se lee antes de hacer el CRC de
+        # toda la ROM (una imagen de NDS puede ocupar cientos de MB)
+        if system not in header_systems or not any(dats.has_system(s) for s in header_systems):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                header = read_rom_header(f.read(ROM_HEADER_SIZE))
+        except OSError:
+            return None
+        header_system = header and LIBRETRO_MAP[header[0]]
+        if header_system and underscored:
+            header_system = header_system.replace(' ', '_')
+        if not header_system or not dats.has_system(header_system):
+            return None
+    rom_id = ids.identify(path)
+    if rom_id is None:
+        return None
+    candidates = [system]
+    if rom_id['platform']:
+        header_system = LIBRETRO_MAP[rom_id['platform']]
+        if ' ' not in system:
+            header_system = header_system.replace(' ', '_')
+        if header_system != system:
+            candidates.append(header_system)
+    for candidate in candidates:
+        name = dats.lookup(candidate, rom_id)
+        if name:
+            return candidate, libretro_thumb_name(name)
+    return None
+
+
+rom_ids = RomIdCache(ROM_IDS_PATH)
+dat_index = RomDatIndex(ROM_DAT_DIR)
+
+PNG_IDAT_SIZE = 64 * 1024
+
+
+def png_chunk(tag, data):
+    return struct.pack('!I', len(data)) + tag + data + struct.pack('!I', zlib.crc32(tag + data) & 0xffffffff)
+
+
+def png_filter_row(filter_type, row, prev, bpp):
+    """Aplicar un filtro PNG (0 None, 1 Sub, 2 Up) a una scanline"""
+    if filter_type == 1:
+        return bytes((row[i] - (row[i - bpp] if i >= bpp else 0)) & 0xff for i in range(len(row)))
+    if filter_type == 2:
+        return bytes((a - b) & 0xff for a, b in zip(row, prev))
+    return bytes(row)
+
+
+def write_png(path, width, height, rgba_bytes, level=6, filter_type=0,
+              strategy=zlib.Z_DEFAULT_STRATEGY, palette=True):
+    """Codificar una imagen RGBA de 8 bits como PNG.
+
+    Las filas se comprimen una a una con compressobj y se escriben en varios
+    IDAT, sin montar el buffer filtrado completo. Si la imagen tiene 256
+    colores o menos (y palette es True) se guarda indexada con PLTE/tRNS; si
+    es opaca, como RGB sin canal alfa.
+    """
+    stride = width * 4
+    view = memoryview(rgba_bytes).cast('B')
+
+    def rows():
+        # Vistas sobre el buffer original, sin copiar la imagen
+        for y in range(height):
+            yield view[y * stride:(y + 1) * stride]
+
+    def repeated(seen, row):
+        """Valor guardado para una fila igual a row (por CRC y comparando), o None"""
+        entry = seen.get(zlib.crc32(row))
+        if entry is not None and view[entry[0]:entry[0] + stride] == row:
+            return entry
+        return None
+
+    lut = None
+    if palette:
+        # Los placeholders repiten muchas filas: contar colores por fila unica
+        colors = set()
+        seen = {}
+        for y, row in enumerate(rows()):
+            if repeated(seen, row):
+                continue
+            seen.setdefault(zlib.crc32(row), (y * stride,))
+            colors.update(row.cast('I'))
+            if len(colors) > 256:
+                break
+        if len(colors) <= 256:
+            # Ordenar por alfa para que el tRNS sea lo mas corto posible
+            entries = sorted((c.to_bytes(4, sys.byteorder) for c in colors), key=lambda rgba: rgba[3])
+            lut = {int.from_bytes(rgba, sys.byteorder): i for i, rgba in enumerate(entries)}
+
+    if lut is not None:
+        header = struct.pack('!2I5B', width, height, 8, 3, 0, 0, 0)
+        extra = png_chunk(b'PLTE', b''.join(rgba[:3] for rgba in entries))
+        alphas = bytes(rgba[3] for rgba in entries).rstrip(b'\xff')
+        if alphas:
+            extra += png_chunk(b'tRNS', alphas)
+        bpp = 1
+    elif all(not bytes(row[3::4]).strip(b'\xff') for row in rows()):
+        header = struct.pack('!2I5B', width, height, 8, 2, 0, 0, 0)
+        extra = b''
+        bpp = 3
+    else:
+        header = struct.pack('!2I5B', width, height, 8, 6, 0, 0, 0)
+        extra = b''
+        bpp = 4
 
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 8, strategy)
+    prev = bytes(width * bpp)
+    pending = bytearray()
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header) + extra)
+            indexed = {}
+            for y, row in enumerate(rows()):
+                if lut is not None:
+                    cached = repeated(indexed, row)
+                    if cached is None:
+                        cached = (y * stride, bytes(map(lut.__getitem__, row.cast('I'))))
+                        indexed.setdefault(zlib.crc32(row), cached)
+                    row = cached[1]
+                elif bpp == 3:
+                    rgb = bytearray(width * 3)
+                    rgb[0::3] = row[0::4]
+                    rgb[1::3] = row[1::4]
+                    rgb[2::3] = row[2::4]
+                    row = bytes(rgb)
+                pending += compressor.compress(bytes([filter_type]) + png_filter_row(filter_type, row, prev, bpp))
+                prev = row
+                if len(pending) >= PNG_IDAT_SIZE:
+                    f.write(png_chunk(b'IDAT', bytes(pending)))
+                    pending.clear()
+            pending += compressor.flush()
+            f.write(png_chunk(b'IDAT', bytes(pending)) + png_chunk(b'IEND', b''))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+PNG_MAX_PIXELS = 4096 * 4096
+ADAM7_PASSES = [(0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4), (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2)]
+_png_byte = (255).__and__
+
+
+def png_unfilter_row(filter_type, row, prev, bpp):
+    """Deshacer el filtro PNG de una scanline (bytearray, in situ)"""
+    n = len(row)
+    if filter_type == 1:
+        for c in range(bpp):
+            row[c::bpp] = bytes(map(_png_byte, itertools.accumulate(row[c::bpp])))
+    elif filter_type == 2:
+        row[:] = bytes(map(_png_byte, map(operator.add, row, prev)))
+    elif filter_type == 3:
+        for i in range(n):
+            left = row[i - bpp] if i >= bpp else 0
+            row[i] = (row[i] + ((left + prev[i]) >> 1)) & 0xff
+    elif filter_type == 4:
+        for i in range(min(bpp, n)):
+            row[i] = (row[i] + prev[i]) & 0xff
+        for i in range(bpp, n):
+            a = row[i - bpp]
+            b = prev[i]
+            c = prev[i - bpp]
+            pa = abs(b - c)
+            pb = abs(a - c)
+            pc = abs(a + b - c - c)
+            if pa <= pb and pa <= pc:
+                row[i] = (row[i] + a) & 0xff
+            elif pb <= pc:
+                row[i] = (row[i] + b) & 0xff
+            else:
+                row[i] = (row[i] + c) & 0xff
+    elif filter_type != 0:
+        raise ValueError(f"Unknown PNG filter {filter_type}")
+
+
+def _png_row_to_rgba(raw, width, color_type, depth, palette, trns):
+    """Convertir una scanline ya sin filtro a RGBA de 8 bits"""
+    if depth < 8:
+        # Gris o paleta de 1/2/4 bits: desempaquetar un valor por byte
+        per_byte = 8 // depth
+        mask = (1 << depth) - 1
+        values = bytearray(len(raw) * per_byte)
+        for k in range(per_byte):
+            shift = 8 - depth * (k + 1)
+            values[k::per_byte] = raw.translate(bytes((b >> shift) & mask for b in range(256)))
+        values = bytes(values[:width])
+        if color_type == 3:
+            return bytearray(b''.join(map(palette.__getitem__, values)))
+        transparent = [x for x, v in enumerate(values) if v == trns] if trns is not None else []
+        samples = values.translate(bytes(min(v * (255 // mask), 255) for v in range(256)))
+    else:
+        if color_type == 3:
+            return bytearray(b''.join(map(palette.__getitem__, raw)))
+        size = len(raw) // width
+        transparent = [x for x in range(width) if raw[x * size:(x + 1) * size] == trns] if trns is not None else []
+        samples = bytes(raw[0::2] if depth == 16 else raw)
+
+    out = bytearray(width * 4)
+    if color_type == 0:
+        out[0::4] = samples
+        out[1::4] = samples
+        out[2::4] = samples
+        out[3::4] = b'\xff' * width
+    elif color_type == 2:
+        out[0::4] = samples[0::3]
+        out[1::4] = samples[1::3]
+        out[2::4] = samples[2::3]
+        out[3::4] = b'\xff' * width
+    elif color_type == 4:
+        out[0::4] = samples[0::2]
+        out[1::4] = samples[0::2]
+        out[2::4] = samples[0::2]
+        out[3::4] = samples[1::2]
+    else:
+        out[:] = samples
+    for x in transparent:
+        out[x * 4 + 3] = 0
+    return out
 
-def write_png(path, width, height, rgba_bytes):
-    # rgba_bytes: bytes length width*height*4
-    def chunk(tag, data):
-        return struct.pack('!I', len(data)) + tag + data + struct.pack('!I', zlib.crc32(tag + data) & 0xffffffff)
 
-    raw = bytearray()
+def read_png(path):
+    """Decodificar un PNG a RGBA de 8 bits; devuelve (ancho, alto, bytearray).
+
+    Admite todos los tipos de color y profundidades del estandar, paleta con
+    tRNS y entrelazado Adam7. Lo justo para generar miniaturas.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:8] != b'\x89PNG\r\n\x1a\n':
+        raise ValueError("Not a PNG file")
+    pos = 8
+    header = None
+    plte = b''
+    trns = None
+    idat = []
+    while pos + 8 <= len(data):
+        length, tag = struct.unpack('!I4s', data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if tag == b'IHDR':
+            header = struct.unpack('!2I5B', chunk)
+        elif tag == b'PLTE':
+            plte = chunk
+        elif tag == b'tRNS':
+            trns = chunk
+        elif tag == b'IDAT':
+            idat.append(chunk)
+        elif tag == b'IEND':
+            break
+    if header is None or not idat:
+        raise ValueError("Incomplete PNG")
+    width, height, depth, color_type, _, _, interlace = header
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}.get(color_type)
+    if channels is None or depth not in (1, 2, 4, 8, 16) or width * height > PNG_MAX_PIXELS or not width or not height:
+        raise ValueError(f"Unsupported PNG ({width}x{height}, type {color_type}, depth {depth})")
+
+    palette = None
+    if color_type == 3:
+        alphas = (trns or b'').ljust(256, b'\xff')
+        palette = [plte[i * 3:i * 3 + 3] + alphas[i:i + 1] if i * 3 < len(plte) else b'\0\0\0\xff'
+                   for i in range(256)]
+        trns = None
+    elif trns is not None:
+        # tRNS de gris/RGB: un color exacto, guardado siempre en 16 bits
+        if depth == 16:
+            trns = trns[:channels * 2]
+        elif depth == 8:
+            trns = trns[1:channels * 2:2]
+        else:
+            trns = trns[1]
+
+    raw = zlib.decompress(b''.join(idat))
+    bpp = max(1, channels * depth // 8)
+    passes = ADAM7_PASSES if interlace else [(0, 0, 1, 1)]
+    pixels = array.array('I', bytes(width * height * 4))
+    pos = 0
+    for x0, y0, dx, dy in passes:
+        pass_width = (width - x0 + dx - 1) // dx
+        pass_height = (height - y0 + dy - 1) // dy
+        if not pass_width or not pass_height:
+            continue
+        stride = (pass_width * channels * depth + 7) // 8
+        prev = bytearray(stride)
+        for r in range(pass_height):
+            if pos + 1 + stride > len(raw):
+                raise ValueError("Truncated PNG data")
+            row = bytearray(raw[pos + 1:pos + 1 + stride])
+            png_unfilter_row(raw[pos], row, prev, bpp)
+            pos += 1 + stride
+            prev = row
+            rgba = array.array('I', _png_row_to_rgba(row, pass_width, color_type, depth, palette, trns))
+            start = (y0 + r * dy) * width
+            pixels[start + x0:start + width:dx] = rgba
+    return width, height, bytearray(pixels.tobytes())
+
+
+def resize_rgba(rgba, width, height, new_width, new_height):
+    """Reducir una imagen RGBA promediando cada bloque de pixeles (box filter)"""
     stride = width * 4
-    for y in range(height):
-        raw.append(0)
-        start = y * stride
-        raw.extend(rgba_bytes[start:start+stride])
-    compressed = zlib.compress(bytes(raw), level=6)
-
-    header = struct.pack('!2I5B', width, height, 8, 6, 0, 0, 0)
-    png = b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', compressed) + chunk(b'IEND', b'')
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, 'wb') as f:
-        f.write(png)
+    xs = [x * width // new_width for x in range(new_width + 1)]
+    ys = [y * height // new_height for y in range(new_height + 1)]
+    starts = xs[:-1]
+    ends = [max(x1, x0 + 1) for x0, x1 in zip(xs, xs[1:])]
+    areas_by_rows = {}
+    out = bytearray(new_width * new_height * 4)
+    for oy in range(new_height):
+        y0, y1 = ys[oy], max(ys[oy + 1], ys[oy] + 1)
+        # Primero se suman las filas del bloque columna a columna...
+        acc = list(rgba[y0 * stride:(y0 + 1) * stride])
+        for y in range(y0 + 1, y1):
+            acc = list(map(operator.add, acc, rgba[y * stride:(y + 1) * stride]))
+        if y1 - y0 not in areas_by_rows:
+            areas = [(x1 - x0) * (y1 - y0) for x0, x1 in zip(starts, ends)]
+            areas_by_rows[y1 - y0] = (areas, [n // 2 for n in areas])
+        areas, halves = areas_by_rows[y1 - y0]
+        # ...y luego cada grupo de columnas con sumas acumuladas por canal
+        base = oy * new_width * 4
+        for c in range(4):
+            prefix = list(itertools.accumulate(acc[c::4], initial=0))
+            sums = map(operator.sub, map(prefix.__getitem__, ends), map(prefix.__getitem__, starts))
+            out[base + c:base + new_width * 4:4] = bytes(
+                map(operator.floordiv, map(operator.add, sums, halves), areas))
+    return out
 
 
-def draw_text(buffer, width, height, x, y, text, color, scale=2):
-    font = {
-        'A': ["01110","10001","10001","11111","10001","10001","10001"],
-        'B': ["11110","10001","10001","11110","10001","10001","11110"],
-        'C': ["01110","10001","10000","10000","10000","10001","01110"],
-        'D': ["11100","10010","10001","10001","10001","10010","11100"],
-        'E': ["11111","10000","10000","11110","10000","10000","11111"],
-        'F': ["11111","10000","10000","11110","10000","10000","10000"],
-        'G': ["01110","10001","10000","10111","10001","10001","01110"],
-        'H': ["10001","10001","10001","11111","10001","10001","10001"],
-        'I': ["11111","00100","00100","00100","00100","00100","11111"],
-        'J': ["00111","00010","00010","00010","10010","10010","01100"],
-        'K': ["10001","10010","10100","11000","10100","10010","10001"],
-        'L': ["10000","10000","10000","10000","10000","10000","11111"],
-        'M': ["10001","11011","10101","10101","10001","10001","10001"],
-        'N': ["10001","11001","10101","10011","10001","10001","10001"],
-        'O': ["01110","10001","10001","10001","10001","10001","01110"],
-        'P': ["11110","10001","10001","11110","10000","10000","10000"],
-        'Q': ["01110","10001","10001","10001","10101","10010","01101"],
-        'R': ["11110","10001","10001","11110","10100","10010","10001"],
-        'S': ["01111","10000","10000","01110","00001","00001","11110"],
-        'T': ["11111","00100","00100","00100","00100","00100","00100"],
-        'U': ["10001","10001","10001","10001","10001","10001","01110"],
-        'V': ["10001","10001","10001","10001","10001","01010","00100"],
-        'W': ["10001","10001","10001","10101","10101","10101","01010"],
-        'X': ["10001","10001","01010","00100","01010","10001","10001"],
-        'Y': ["10001","10001","01010","00100","00100","00100","00100"],
-        'Z': ["11111","00001","00010","00100","01000","10000","11111"],
-        '0': ["01110","10001","10011","10101","11001","10001","01110"],
-        '1': ["00100","01100","00100","00100","00100","00100","01110"],
-        '2': ["01110","10001","00001","00010","00100","01000","11111"],
-        '3': ["11110","00001","00001","01110","00001","00001","11110"],
-        '4': ["00010","00110","01010","10010","11111","00010","00010"],
-        '5': ["11111","10000","10000","11110","00001","00001","11110"],
-        '6': ["01110","10000","10000","11110","10001","10001","01110"],
-        '7': ["11111","00001","00010","00100","01000","01000","01000"],
-        '8': ["01110","10001","10001","01110","10001","10001","01110"],
-        '9': ["01110","10001","10001","01111","00001","00001","01110"],
-        '-': ["00000","00000","00000","11111","00000","00000","00000"],
-        '.': ["00000","00000","00000","00000","00000","00110","00110"],
-        ',': ["00000","00000","00000","00000","00110","00110","01100"],
-        ' ': ["00000","00000","00000","00000","00000","00000","00000"],
-        '&': ["01100","10010","10100","01000","10101","10010","01101"],
-        "'": ["00100","00100","00000","00000","00000","00000","00000"],
-        ':': ["00000","00110","00110","00000","00110","00110","00000"],
-    }
+FONT = {
+    'A': ["01110","10001","10001","11111","10001","10001","10001"],
+    'B': ["11110","10001","10001","11110","10001","10001","11110"],
+    'C': ["01110","10001","10000","10000","10000","10001","01110"],
+    'D': ["11100","10010","10001","10001","10001","10010","11100"],
+    'E': ["11111","10000","10000","11110","10000","10000","11111"],
+    'F': ["11111","10000","10000","11110","10000","10000","10000"],
+    'G': ["01110","10001","10000","10111","10001","10001","01110"],
+    'H': ["10001","10001","10001","11111","10001","10001","10001"],
+    'I': ["11111","00100","00100","00100","00100","00100","11111"],
+    'J': ["00111","00010","00010","00010","10010","10010","01100"],
+    'K': ["10001","10010","10100","11000","10100","10010","10001"],
+    'L': ["10000","10000","10000","10000","10000","10000","11111"],
+    'M': ["10001","11011","10101","10101","10001","10001","10001"],
+    'N': ["10001","11001","10101","10011","10001","10001","10001"],
+    'O': ["01110","10001","10001","10001","10001","10001","01110"],
+    'P': ["11110","10001","10001","11110","10000","10000","10000"],
+    'Q': ["01110","10001","10001","10001","10101","10010","01101"],
+    'R': ["11110","10001","10001","11110","10100","10010","10001"],
+    'S': ["01111","10000","10000","01110","00001","00001","11110"],
+    'T': ["11111","00100","00100","00100","00100","00100","00100"],
+    'U': ["10001","10001","10001","10001","10001","10001","01110"],
+    'V': ["10001","10001","10001","10001","10001","01010","00100"],
+    'W': ["10001","10001","10001","10101","10101","10101","01010"],
+    'X': ["10001","10001","01010","00100","01010","10001","10001"],
+    'Y': ["10001","10001","01010","00100","00100","00100","00100"],
+    'Z': ["11111","00001","00010","00100","01000","10000","11111"],
+    '0': ["01110","10001","10011","10101","11001","10001","01110"],
+    '1': ["00100","01100","00100","00100","00100","00100","01110"],
+    '2': ["01110","10001","00001","00010","00100","01000","11111"],
+    '3': ["11110","00001","00001","01110","00001","00001","11110"],
+    '4': ["00010","00110","01010","10010","11111","00010","00010"],
+    '5': ["11111","10000","10000","11110","00001","00001","11110"],
+    '6': ["01110","10000","10000","11110","10001","10001","01110"],
+    '7': ["11111","00001","00010","00100","01000","01000","01000"],
+    '8': ["01110","10001","10001","01110","10001","10001","01110"],
+    '9': ["01110","10001","10001","01111","00001","00001","01110"],
+    '-': ["00000","00000","00000","11111","00000","00000","00000"],
+    '.': ["00000","00000","00000","00000","00000","00110","00110"],
+    ',': ["00000","00000","00000","00000","00110","00110","01100"],
+    ' ': ["00000","00000","00000","00000","00000","00000","00000"],
+    '&': ["01100","10010","10100","01000","10101","10010","01101"],
+    "'": ["00100","00100","00000","00000","00000","00000","00000"],
+    ':': ["00000","00110","00110","00000","00110","00110","00000"],
+}
+
+# Tramos de pixeles encendidos por (caracter, escala); se calculan una vez
+glyph_runs_cache = {}
+gradient_cache = {}
+
+
+def glyph_runs(ch, scale):
+    """Tramos horizontales (dx, dy, ancho) de un glifo ya escalado"""
+    key = (ch, scale)
+    runs = glyph_runs_cache.get(key)
+    if runs is None:
+        runs = []
+        for row, rowbits in enumerate(FONT[ch]):
+            for m in re.finditer('1+', rowbits):
+                for sy in range(scale):
+                    runs.append((m.start() * scale, row * scale + sy, (m.end() - m.start()) * scale))
+        glyph_runs_cache[key] = runs
+    return runs
 
-    text = ''.join(ch if ch in font else ' ' for ch in text)
+
+def draw_text(buffer, width, height, x, y, text, color, scale=2):
+    pixel = bytes(color)
     cursor_x = x
     for ch in text:
-        glyph = font.get(ch)
-        if glyph:
-            for row, rowbits in enumerate(glyph):
-                for col, bit in enumerate(rowbits):
-                    if bit == '1':
-                        for sy in range(scale):
-                            py = y + row * scale + sy
-                            if 0 <= py < height:
-                                for sx in range(scale):
-                                    px = cursor_x + col * scale + sx
-                                    if 0 <= px < width:
-                                        idx = (py * width + px) * 4
-                                        buffer[idx:idx+4] = bytes(color)
+        if ch not in FONT:
+            ch = ' '
+        # Cada tramo se copia de una vez en lugar de pixel a pixel
+        for dx, dy, run in glyph_runs(ch, scale):
+            py = y + dy
+            if not 0 <= py < height:
+                continue
+            x0 = max(cursor_x + dx, 0)
+            x1 = min(cursor_x + dx + run, width)
+            if x0 < x1:
+                idx = (py * width + x0) * 4
+                buffer[idx:idx + (x1 - x0) * 4] = pixel * (x1 - x0)
         cursor_x += (6 * scale)
 
 
+def gradient_background(width, height):
+    """Copia del fondo degradado de los placeholders (cacheado por tamaño)"""
+    key = (width, height)
+    background = gradient_cache.get(key)
+    if background is None:
+        rows = []
+        for y in range(height):
+            t = y / (height - 1)
+            r = int(15 + (26-15) * t)
+            g = int(52 + (26-52) * t)
+            b = int(96 + (46-96) * t)
+            rows.append(bytes([r, g, b, 255]) * width)
+        background = gradient_cache[key] = b''.join(rows)
+    return bytearray(background)
+
+
 def create_placeholder_png(path, title, console_name):
     width = 512
     height = 512
-    buf = bytearray(width * height * 4)
-    # gradient
-    for y in range(height):
-        t = y / (height - 1)
-        r = int(15 + (26-15) * t)
-        g = int(52 + (26-52) * t)
-        b = int(96 + (46-96) * t)
-        for x in range(width):
-            idx = (y * width + x) * 4
-            buf[idx:idx+4] = bytes([r, g, b, 255])
+    buf = gradient_background(width, height)
 
     # title
     title = title.upper()
@@ -254,23 +1573,372 @@ def create_placeholder_png(path, title, console_name):
     write_png(path, width, height, buf)
 
 
-def scan_thumbnails(consoles):
-    with thumb_scan_lock:
-        if thumb_scan_state["running"]:
+placeholder_pool = None
+placeholder_pool_lock = threading.Lock()
+
+
+def get_placeholder_pool():
+    global placeholder_pool
+    with placeholder_pool_lock:
+        if placeholder_pool is None and PLACEHOLDER_PROCESSES > 0:
+            # spawn: hacer fork de un proceso con hilos activos puede heredar
+            # locks tomados
+            placeholder_pool = ProcessPoolExecutor(
+                max_workers=PLACEHOLDER_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return placeholder_pool
+
+
+def shutdown_placeholder_pool():
+    global placeholder_pool
+    with placeholder_pool_lock:
+        if placeholder_pool is not None:
+            placeholder_pool.shutdown(wait=False, cancel_futures=True)
+            placeholder_pool = None
+
+
+def run_image_task(func, *args):
+    """Ejecutar un trabajo de imagen en el pool de procesos (o en linea si no hay)"""
+    pool = get_placeholder_pool()
+    if pool is None:
+        return func(*args)
+    try:
+        return pool.submit(func, *args).result()
+    except BrokenProcessPool:
+        log_thumb("[WARN] placeholder process pool died, restarting")
+        shutdown_placeholder_pool()
+        return func(*args)
+
+
+def render_placeholder(path, title, console_name):
+    """Generar un placeholder en el pool de procesos (o en linea si no hay)"""
+    started = time.monotonic()
+    result = run_image_task(create_placeholder_png, path, title, console_name)
+    metrics_placeholder_seconds.observe(time.monotonic() - started)
+    return result
+
+
+def thumb_size_path(path, size):
+    """Ruta de la miniatura de path para el grid: <carpeta>/.sizes/<size>/<nombre>"""
+    return os.path.join(os.path.dirname(path), THUMB_SIZES_DIR, str(size), os.path.basename(path))
+
+
+def create_thumb_sizes(path, sizes=None):
+    """Generar las miniaturas de un thumbnail (lado mayor <= cada tamaño)"""
+    width, height, rgba = read_png(path)
+    # De mayor a menor: cada miniatura se reduce a partir de la anterior
+    for size in sorted(sizes or THUMB_GRID_SIZES, reverse=True):
+        target = thumb_size_path(path, size)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        scale = min(size / width, size / height)
+        if scale >= 1:
+            # Ya es pequeña: la miniatura es una copia
+            tmp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, target)
+            continue
+        new_width = max(1, round(width * scale))
+        new_height = max(1, round(height * scale))
+        rgba = resize_rgba(rgba, width, height, new_width, new_height)
+        width, height = new_width, new_height
+        write_png(target, width, height, rgba)
+
+
+# Originales que no se pudieron leer: ruta -> (mtime, tamaño). No se vuelven
+# a intentar (ni a registrar) hasta que el fichero cambie
+thumb_size_failures = OrderedDict()
+thumb_size_failures_lock = threading.Lock()
+THUMB_SIZE_FAILURES_KEEP = 10000
+
+
+def render_thumb_sizes(path):
+    """Generar las miniaturas de path; un PNG que no se puede leer solo se registra"""
+    try:
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        stamp = None
+    with thumb_size_failures_lock:
+        if stamp and thumb_size_failures.get(path) == stamp:
             return False
-        thumb_scan_state.update({
-            "running": True,
-            "total": 0,
-            "processed": 0,
-            "found": 0,
-            "generated": 0,
-            "failed": 0,
-            "current": "",
-            "started_at": time.time(),
-            "finished_at": None
-        })
+    try:
+        started = time.monotonic()
+        run_image_task(create_thumb_sizes, path)
+        metrics_sizes_seconds.observe(time.monotonic() - started)
+        with thumb_size_failures_lock:
+            thumb_size_failures.pop(path, None)
+        return True
+    except (OSError, ValueError, zlib.error) as e:
+        log_thumb(f"[WARN] No grid sizes for {os.path.basename(path)}: {e}")
+        if stamp:
+            with thumb_size_failures_lock:
+                thumb_size_failures[path] = stamp
+                thumb_size_failures.move_to_end(path)
+                while len(thumb_size_failures) > THUMB_SIZE_FAILURES_KEEP:
+                    thumb_size_failures.popitem(last=False)
+        return False
+
+
+def build_atlas(paths, target, max_width):
+    """Montar varias imagenes en un solo PNG por filas (shelf packing).
+
+    Devuelve (ancho, alto, cajas) con una caja [x, y, w, h] por imagen, o
+    None si no se pudo leer.
+    """
+    images = []
+    for path in paths:
+        try:
+            images.append(read_png(path))
+        except (OSError, ValueError, zlib.error):
+            images.append(None)
+
+    boxes = []
+    x = y = row_height = atlas_width = 0
+    for image in images:
+        if image is None:
+            boxes.append(None)
+            continue
+        w, h, _ = image
+        if x and x + w > max_width:
+            y += row_height
+            x = row_height = 0
+        boxes.append([x, y, w, h])
+        x += w
+        row_height = max(row_height, h)
+        atlas_width = max(atlas_width, x)
+    atlas_height = y + row_height
+    if not atlas_width:
+        return 0, 0, boxes
+
+    buf = bytearray(atlas_width * atlas_height * 4)
+    for image, box in zip(images, boxes):
+        if box is None:
+            continue
+        w, h, rgba = image
+        bx, by = box[0], box[1]
+        for r in range(h):
+            start = ((by + r) * atlas_width + bx) * 4
+            buf[start:start + w * 4] = rgba[r * w * 4:(r + 1) * w * 4]
+    write_png(target, atlas_width, atlas_height, buf)
+    return atlas_width, atlas_height, boxes
+
 
+atlas_locks = [threading.Lock() for _ in range(ATLAS_LOCK_STRIPES)]
+
+
+def _atlas_lock(key):
+    return atlas_locks[int(key[:8], 16) % ATLAS_LOCK_STRIPES]
+
+
+def prune_atlas_cache():
+    """Borrar los atlas menos usados por encima de ATLAS_CACHE_MAX"""
+    try:
+        entries = [e for e in os.scandir(ATLAS_CACHE_DIR) if e.name.endswith('.json')]
+    except FileNotFoundError:
+        return
+    if len(entries) <= ATLAS_CACHE_MAX:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for entry in entries[:len(entries) - ATLAS_CACHE_MAX]:
+        for path in (entry.path, entry.path[:-len('.json')] + '.png'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def get_thumb_atlas(console, names, size, inline=False):
+    """Atlas de las miniaturas de una pagina de juegos de una consola.
+
+    La clave depende del mtime y tamaño de cada thumbnail original, asi que
+    cambiar cualquiera de ellos genera un atlas nuevo; los viejos se van
+    borrando con prune_atlas_cache. Con inline el PNG va en la respuesta
+    (base64 en 'data') y la pagina se pinta con una sola peticion.
+    """
+    members = []
+    missing = []
+    for name in names:
+        original = os.path.join(THUMBNAILS_DIR, console, f"{name}.png")
+        try:
+            st = os.stat(original)
+        except FileNotFoundError:
+            missing.append(name)
+            continue
+        members.append((name, original, st.st_mtime_ns, st.st_size))
+    key = hashlib.sha1(json.dumps(
+        [console, size, [(m[0], m[2], m[3]) for m in members]]).encode()).hexdigest()
+    layout_path = os.path.join(ATLAS_CACHE_DIR, f"{key}.json")
+
+    with _atlas_lock(key):
+        try:
+            with open(layout_path) as f:
+                layout = json.load(f)
+            os.utime(layout_path)
+        except (OSError, ValueError):
+            layout = None
+        if layout is None:
+            stale = []
+            for name, original, mtime, _ in members:
+                try:
+                    if os.stat(thumb_size_path(original, size)).st_mtime_ns >= mtime:
+                        continue
+                except FileNotFoundError:
+                    pass
+                stale.append(original)
+            # Las miniaturas que faltan se generan a la vez en el pool
+            failed = set()
+            if stale:
+                with ThreadPoolExecutor(max_workers=max(1, PLACEHOLDER_PROCESSES)) as executor:
+                    failed = {p for p, ok in zip(stale, executor.map(render_thumb_sizes, stale)) if not ok}
+            paths = [m[1] if m[1] in failed else thumb_size_path(m[1], size) for m in members]
+            os.makedirs(ATLAS_CACHE_DIR, exist_ok=True)
+            width, height, boxes = run_image_task(
+                build_atlas, paths, os.path.join(ATLAS_CACHE_DIR, f"{key}.png"), ATLAS_COLUMNS * size)
+            layout = {
+                'key': key,
+                'width': width,
+                'height': height,
+                'size': size,
+                'items': {m[0]: box for m, box in zip(members, boxes) if box},
+                'missing': [m[0] for m, box in zip(members, boxes) if not box]
+            }
+            tmp_path = f"{layout_path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(layout, f)
+            os.replace(tmp_path, layout_path)
+            prune_atlas_cache()
+        data = None
+        if inline and layout['items']:
+            with open(os.path.join(ATLAS_CACHE_DIR, f"{key}.png"), 'rb') as f:
+                data = base64.b64encode(f.read()).decode()
+
+    layout = dict(layout)
+    layout['missing'] = layout['missing'] + missing
+    layout['url'] = f"/thumbs/atlas/{key}.png" if layout['items'] else None
+    if inline:
+        layout['data'] = data
+    return layout
+
+
+def copy_twin_thumbnail(console, fname, thumb_path):
+    """Copiar el thumbnail de otra ROM con el mismo contenido, si lo tiene"""
+    digest = rom_index.digest(f"{console}/{fname}", compute=False)
+    if not digest:
+        return False
+    for rel in rom_index.paths(digest):
+        twin_console, _, twin_file = rel.partition('/')
+        twin = os.path.join(THUMBNAILS_DIR, twin_console, f"{clean_game_name(twin_file)}.png")
+        if twin == thumb_path or not os.path.isfile(twin):
+            continue
+        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+        # Copia y no enlace: los thumbnails se sobrescriben en su sitio
+        shutil.copyfile(twin, thumb_path)
+        for size in THUMB_GRID_SIZES:
+            if os.path.isfile(thumb_size_path(twin, size)):
+                os.makedirs(os.path.dirname(thumb_size_path(thumb_path, size)), exist_ok=True)
+                shutil.copyfile(thumb_size_path(twin, size), thumb_size_path(thumb_path, size))
+        return True
+    return False
+
+
+def scan_one_thumbnail(job, console, fname, clean, thumb_path, system):
+    if copy_twin_thumbnail(console, fname, thumb_path):
+        log_thumb(f"[OK] {console}: {clean} (same ROM as an existing thumbnail)")
+        job.count("found")
+        return
+    ok = False
+    source = "libretro"
+    try:
+        identified = identify_libretro_name(os.path.join(ROMS_DIR, console, fname), system, rom_ids, dat_index)
+    except (OSError, ValueError) as e:
+        log_thumb(f"[WARN] {console}/{fname}: could not identify ROM ({e})")
+        identified = None
+    if identified:
+        # La ROM esta en el DAT: su nombre es el de libretro, sin adivinar
+        dat_system, dat_name = identified
+        match = libretro_index.resolve(dat_system, dat_name) if libretro_index.has_system(dat_system) else None
+        types = [match[1]] if match and match[0] == dat_name else None
+        ok = try_download_libretro(dat_system, dat_name, thumb_path, types=types)
+        source = f"DAT: {dat_name}"
+    elif system and libretro_index.has_system(system):
+        # Con indice local basta una sola descarga del nombre exacto
+        for name in name_variations(clean):
+            match = libretro_index.resolve(system, name)
+            if match:
+                ok = try_download_libretro(system, match[0], thumb_path, types=[match[1]])
+                break
+    elif system:
+        candidates = candidate_stats.order(system, "pattern", name_candidates(clean), key=lambda c: c[0])
+        for pattern, name in candidates:
+            ok = try_download_libretro(system, name, thumb_path)
+            # Solo cuentan las respuestas reales del servidor
+            if ok is not None:
+                candidate_stats.record(system, "pattern", pattern, ok)
+            if ok:
+                break
+    if ok:
+        log_thumb(f"[OK] {console}: {clean} ({source})")
+        job.count("found")
+    else:
+        try:
+            render_placeholder(thumb_path, clean, system or console)
+            log_thumb(f"[GEN] {console}: {clean} (placeholder)")
+            job.count("generated")
+            ok = True
+        except Exception as e:
+            log_thumb(f"[FAIL] {console}: {clean} ({e})")
+            job.count("failed")
+
+
+scan_snapshot = None
+scan_snapshot_lock = threading.Lock()
+
+
+def get_scan_snapshot():
+    """Ultimo estado visto de cada carpeta de consola (mtimes y ficheros)"""
+    global scan_snapshot
+    with scan_snapshot_lock:
+        if scan_snapshot is None:
+            try:
+                with open(os.path.join(CACHE_DIR, "scan_snapshot.json")) as f:
+                    scan_snapshot = json.load(f)
+            except (OSError, ValueError):
+                scan_snapshot = {}
+        return scan_snapshot
+
+
+def save_scan_snapshot(updates):
+    with scan_snapshot_lock:
+        scan_snapshot.update(updates)
+        path = os.path.join(CACHE_DIR, "scan_snapshot.json")
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(scan_snapshot, f)
+        os.replace(tmp_path, path)
+
+
+def _dir_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def collect_scan_tasks(consoles, incremental=False, files=None):
+    """Listar las ROMs sin thumbnail.
+
+    Usa un scandir por carpeta de ROMs y un listdir por carpeta de
+    thumbnails. En modo incremental se saltan las consolas cuyas carpetas no
+    han cambiado desde el ultimo escaneo y, del resto, las ROMs que ya se
+    procesaron y no han cambiado. Con files solo se miran esas ROMs y no se
+    actualiza el snapshot. Devuelve (tareas, snapshot nuevo).
+    """
+    snapshot = get_scan_snapshot() if incremental else {}
     tasks = []
+    updates = {}
+    seen_paths = set()
     for entry in consoles:
         console = entry.get('console') if isinstance(entry, dict) else None
         if not console:
@@ -278,55 +1946,1078 @@ def scan_thumbnails(consoles):
         system = entry.get('system') or LIBRETRO_MAP.get(console)
         exts = entry.get('extensions') or ROM_EXTENSIONS.get(console, [])
         rom_dir = os.path.join(ROMS_DIR, console)
-        if not os.path.isdir(rom_dir):
+        thumb_dir = os.path.join(THUMBNAILS_DIR, console)
+        rom_mtime = _dir_mtime(rom_dir)
+        if rom_mtime is None:
             continue
-        for fname in os.listdir(rom_dir):
-            lower = fname.lower()
-            if exts and not any(lower.endswith(ext) for ext in exts):
-                continue
-            clean = clean_game_name(fname)
-            thumb_path = os.path.join(THUMBNAILS_DIR, console, f"{clean}.png")
-            if os.path.exists(thumb_path):
-                continue
-            tasks.append((console, fname, clean, thumb_path, system))
+        thumb_mtime = _dir_mtime(thumb_dir)
+        settings = [system, sorted(exts)]
+        previous = snapshot.get(console)
+        if previous and previous['settings'] != settings:
+            previous = None
+        if previous and previous['rom_mtime'] == rom_mtime and previous['thumb_mtime'] == thumb_mtime:
+            continue
+        # Si faltan thumbnails que antes estaban hay que revisar todas las ROMs
+        thumbs_changed = not previous or previous['thumb_mtime'] != thumb_mtime
+        known = previous['files'] if previous else {}
+        thumbs = set(os.listdir(thumb_dir)) if thumb_mtime is not None else set()
+
+        seen = {}
+        with os.scandir(rom_dir) as it:
+            for rom in it:
+                lower = rom.name.lower()
+                if exts and not any(lower.endswith(ext) for ext in exts):
+                    continue
+                if files is not None and rom.name not in files:
+                    continue
+                st = rom.stat()
+                seen[rom.name] = [st.st_size, st.st_mtime_ns]
+                if not thumbs_changed and known.get(rom.name) == seen[rom.name]:
+                    continue
+                clean = clean_game_name(rom.name)
+                thumb_path = os.path.join(thumb_dir, f"{clean}.png")
+                # Dos ROMs con el mismo nombre limpio comparten thumbnail; con
+                # varios workers acabarian escribiendo el mismo fichero a la vez
+                if thumb_path in seen_paths or f"{clean}.png" in thumbs:
+                    continue
+                seen_paths.add(thumb_path)
+                tasks.append((console, rom.name, clean, thumb_path, system))
+        if files is None:
+            updates[console] = {'settings': settings, 'rom_mtime': rom_mtime, 'files': seen}
+    return tasks, updates
+
+
+class ScanJob:
+    """Un escaneo encolado: consolas (o una lista de ROMs), prioridad y progreso"""
+
+    COUNTERS = ("total", "processed", "found", "generated", "failed", "skipped")
+
+    def __init__(self, consoles, priority=0, incremental=False, files=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.consoles = consoles
+        self.priority = priority
+        self.incremental = incremental
+        self.files = set(files) if files is not None else None
+        self.status = "queued"
+        self.counts = dict.fromkeys(self.COUNTERS, 0)
+        self.current = ""
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancelled = False
+        self.seq = 0
+        # Tareas del trabajo en cola o en curso; al llegar a 0 ha terminado
+        self.pending = 0
+        self.updates = {}
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    def count(self, key):
+        with thumb_scan_lock:
+            self.counts[key] += 1
+        thumb_events.notify()
+
+    def view(self):
+        return dict(self.counts, **{
+            "id": self.id,
+            "consoles": [c['console'] for c in self.consoles],
+            "files": len(self.files) if self.files is not None else None,
+            "priority": self.priority,
+            "incremental": self.incremental,
+            "status": self.status,
+            "current": self.current,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        })
 
-    with thumb_scan_lock:
-        thumb_scan_state["total"] = len(tasks)
 
-    for console, fname, clean, thumb_path, system in tasks:
+class ScanScheduler:
+    """Cola de trabajos de escaneo con prioridad sobre un presupuesto comun de workers.
+
+    Cada trabajo empieza con una tarea que lista sus ROMs sin thumbnail y
+    encola una tarea por ROM. Los workers siempre toman la tarea del trabajo
+    de mayor prioridad (a igualdad, del mas antiguo), asi que el escaneo de
+    una consola adelanta a uno de toda la biblioteca sin esperar a que
+    termine. Todo el estado se protege con thumb_scan_lock.
+    """
+
+    def __init__(self, workers=SCAN_WORKERS, keep=SCAN_JOBS_KEEP):
+        self.workers = workers
+        self.keep = keep
+        self.heap = []
+        self.jobs = OrderedDict()
+        # Trabajos desde la ultima vez que no habia ninguno activo; /thumbs/status
+        # los agrega como si fueran un solo escaneo
+        self.batch = []
+        self.batch_finished_at = None
+        self.inflight = set()
+        self.threads = []
+        self.job_seq = itertools.count(1)
+
+    def _push(self, job, order, task):
+        heapq.heappush(self.heap, (-job.priority, job.seq, order, job, task))
+        job.pending += 1
+        thumb_scan_lock.notify()
+
+    def submit(self, job):
         with thumb_scan_lock:
-            thumb_scan_state["current"] = f"{console}/{fname}"
-        ok = False
-        if system:
-            for name in name_variations(clean):
-                if try_download_libretro(system, name, thumb_path):
-                    ok = True
-                    break
-        if ok:
-            log_thumb(f"[OK] {console}: {clean} (libretro)")
+            if not any(j.active for j in self.batch):
+                self.batch = []
+                self.batch_finished_at = None
+            job.seq = next(self.job_seq)
+            self.batch.append(job)
+            self.jobs[job.id] = job
+            for old_id in [i for i, j in self.jobs.items() if not j.active][:max(0, len(self.jobs) - self.keep)]:
+                del self.jobs[old_id]
+            # Orden 0: listar las ROMs antes que cualquier ROM del trabajo
+            self._push(job, 0, None)
+            while len(self.threads) < self.workers:
+                t = threading.Thread(target=self._worker, name=f"scan-{len(self.threads)}", daemon=True)
+                t.start()
+                self.threads.append(t)
+        targets = ', '.join(c['console'] for c in job.consoles)
+        log_thumb(f"[QUEUED] job {job.id}: {targets} (priority {job.priority})")
+        thumb_events.notify()
+        return job
+
+    def view(self, job_id):
+        with thumb_scan_lock:
+            return self.jobs[job_id].view()
+
+    def list(self):
+        with thumb_scan_lock:
+            return [job.view() for job in reversed(self.jobs.values())]
+
+    def cancel(self, job_id):
+        """Cancelar un trabajo: sus ROMs en cola se descartan y las que estan en curso terminan"""
+        with thumb_scan_lock:
+            job = self.jobs[job_id]
+            if not job.active or job.cancelled:
+                return job.view()
+            job.cancelled = True
+            kept = [entry for entry in self.heap if entry[3] is not job]
+            job.pending -= len(self.heap) - len(kept)
+            self.heap = kept
+            heapq.heapify(self.heap)
+            finished = job.pending == 0
+        log_thumb(f"[CANCEL] job {job.id}")
+        if finished:
+            self._finish(job)
+        thumb_events.notify()
+        return self.view(job_id)
+
+    def status(self):
+        """Progreso agregado de los trabajos recientes (formato de /thumbs/status)"""
+        with thumb_scan_lock:
+            running = any(job.active for job in self.batch)
+            state = {key: sum(job.counts[key] for job in self.batch) for key in ScanJob.COUNTERS}
+            started = [job.started_at for job in self.batch if job.started_at]
+            state.update({
+                "running": running,
+                "current": next((job.current for job in reversed(self.batch) if job.current), ""),
+                "started_at": min(started) if started else None,
+                "finished_at": None if running else self.batch_finished_at,
+                "queued": len(self.heap),
+                "jobs": [job.view() for job in self.batch],
+            })
+            return state
+
+    def _worker(self):
+        while True:
             with thumb_scan_lock:
-                thumb_scan_state["found"] += 1
-        else:
+                while not self.heap:
+                    thumb_scan_lock.wait()
+                _, _, _, job, task = heapq.heappop(self.heap)
+                if job.status == "queued":
+                    job.status = "running"
+                    job.started_at = time.time()
             try:
-                create_placeholder_png(thumb_path, clean, system or console)
-                log_thumb(f"[GEN] {console}: {clean} (placeholder)")
-                with thumb_scan_lock:
-                    thumb_scan_state["generated"] += 1
+                if task is None:
+                    self._plan(job)
+                else:
+                    self._run(job, task)
             except Exception as e:
-                log_thumb(f"[FAIL] {console}: {clean} ({e})")
+                log_thumb(f"[FAIL] job {job.id}: {e}")
                 with thumb_scan_lock:
-                    thumb_scan_state["failed"] += 1
-
+                    if task is None:
+                        job.error = str(e)
+                    else:
+                        job.counts["failed"] += 1
+            with thumb_scan_lock:
+                job.pending -= 1
+                finished = job.pending == 0
+            if finished:
+                self._finish(job)
+            thumb_events.notify()
+
+    def _plan(self, job):
+        tasks, updates = collect_scan_tasks(job.consoles, job.incremental, job.files)
         with thumb_scan_lock:
-            thumb_scan_state["processed"] += 1
+            job.updates = updates
+            job.counts["total"] = len(tasks)
+            if not job.cancelled:
+                for order, task in enumerate(tasks, 1):
+                    self._push(job, order, task)
+        targets = ', '.join(c['console'] for c in job.consoles)
+        log_thumb(f"[START] job {job.id}: {targets} ({len(tasks)} ROMs without thumbnail)")
+
+    def _run(self, job, task):
+        console, fname, _, thumb_path, _ = task
+        with thumb_scan_lock:
+            # Otro trabajo ya tiene (o esta generando) este thumbnail
+            duplicate = thumb_path in self.inflight or os.path.exists(thumb_path)
+            if duplicate:
+                job.counts["skipped"] += 1
+                job.counts["processed"] += 1
+                return
+            self.inflight.add(thumb_path)
+            job.current = f"{console}/{fname}"
+        try:
+            scan_one_thumbnail(job, *task)
+        finally:
+            with thumb_scan_lock:
+                self.inflight.discard(thumb_path)
+                job.counts["processed"] += 1
+
+    def _finish(self, job):
+        try:
+            # Un trabajo cancelado no marca sus consolas como revisadas
+            if job.updates and not job.cancelled and not job.error:
+                # El mtime de thumbnails se toma al final: el propio escaneo lo cambia
+                for console, update in job.updates.items():
+                    update['thumb_mtime'] = _dir_mtime(os.path.join(THUMBNAILS_DIR, console))
+                get_scan_snapshot()
+                save_scan_snapshot(job.updates)
+        finally:
+            get_lookup_cache().save()
+            candidate_stats.save()
+            rom_ids.save()
+            with thumb_scan_lock:
+                job.status = "cancelled" if job.cancelled else "failed" if job.error else "done"
+                job.current = ""
+                job.finished_at = time.time()
+                if not any(j.active for j in self.batch):
+                    self.batch_finished_at = job.finished_at
+            log_thumb(f"[DONE] job {job.id}: {job.status}")
+            thumb_events.notify()
 
+
+scan_scheduler = ScanScheduler()
+event_streams = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+resolve_flights = set()
+resolve_flights_lock = threading.Lock()
+# Cada resolucion ocupa un worker HTTP mientras prueba libretro
+resolve_slots = threading.BoundedSemaphore(RESOLVE_MAX_CONCURRENT)
+# Cada descarga ZIP ocupa un worker HTTP mientras se envia
+zip_slots = threading.BoundedSemaphore(ZIP_MAX_CONCURRENT)
+
+
+def _resolve_thumbnail(console, rom, thumb_path, system):
     with thumb_scan_lock:
-        thumb_scan_state["running"] = False
-        thumb_scan_state["finished_at"] = time.time()
-    return True
+        if os.path.exists(thumb_path):
+            return "existing"
+        # Un escaneo lo esta generando: el cliente vuelve a preguntar
+        if thumb_path in scan_scheduler.inflight:
+            return "pending"
+        scan_scheduler.inflight.add(thumb_path)
+    try:
+        # Trabajo suelto, fuera de la cola: solo sirve para contar el resultado
+        job = ScanJob([{'console': console}])
+        scan_one_thumbnail(job, console, rom['file'], rom['name'], thumb_path, system)
+    finally:
+        with thumb_scan_lock:
+            scan_scheduler.inflight.discard(thumb_path)
+    if job.counts["found"]:
+        return "libretro"
+    if job.counts["generated"]:
+        return "placeholder"
+    raise RuntimeError(f"Could not resolve a thumbnail for {console}/{rom['name']}")
+
+
+def resolve_thumbnail(console, rom, system=None):
+    """Buscar (o generar) el thumbnail de una ROM por el mismo camino que el escaneo.
+
+    Solo la primera peticion de cada juego hace la busqueda; las que llegan
+    mientras tanto no esperan ocupando un worker, reciben "pending" y vuelven
+    a preguntar, asi que cada thumbnail se resuelve una vez. Con
+    RESOLVE_MAX_CONCURRENT busquedas en curso devuelve "busy". Devuelve el
+    origen: existing, libretro, placeholder, pending o busy.
+    """
+    thumb_path = os.path.join(THUMBNAILS_DIR, console, f"{rom['name']}.png")
+    if os.path.exists(thumb_path):
+        return "existing"
+    with resolve_flights_lock:
+        if thumb_path in resolve_flights:
+            return "pending"
+        if not resolve_slots.acquire(blocking=False):
+            return "busy"
+        resolve_flights.add(thumb_path)
+    try:
+        return _resolve_thumbnail(console, rom, thumb_path, system or LIBRETRO_MAP.get(console))
+    finally:
+        get_lookup_cache().save()
+        candidate_stats.save()
+        with resolve_flights_lock:
+            resolve_flights.discard(thumb_path)
+        resolve_slots.release()
+
+
+class LibraryCatalog:
+    """Catalogo en memoria de las ROMs de cada consola.
+
+    Cada consola se relee solo si cambia el mtime de su carpeta de ROMs o de
+    thumbnails, si se invalida tras una subida o si pasan CATALOG_MAX_AGE
+    segundos; las entradas cuyo tamaño y mtime no cambian se reutilizan.
+    """
+
+    def __init__(self, max_age=CATALOG_MAX_AGE):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.consoles = {}
+        self.version = 0
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _refresh(self, console):
+        rom_dir = os.path.join(ROMS_DIR, console)
+        thumb_dir = os.path.join(THUMBNAILS_DIR, console)
+        rom_mtime = self._mtime(rom_dir)
+        thumb_mtime = self._mtime(thumb_dir)
+        cached = self.consoles.get(console)
+        if rom_mtime is None:
+            self.consoles.pop(console, None)
+            return None
+        if (cached and cached['rom_mtime'] == rom_mtime and cached['thumb_mtime'] == thumb_mtime
+                and time.time() - cached['checked_at'] < self.max_age):
+            return cached
+
+        previous = cached['entries'] if cached else {}
+        thumbs = set(os.listdir(thumb_dir)) if thumb_mtime is not None else set()
+        entries = {}
+        with os.scandir(rom_dir) as it:
+            for entry in it:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                st = entry.stat()
+                item = dict(previous.get(entry.name) or {})
+                if not item or item['size'] != st.st_size or item['mtime'] != int(st.st_mtime):
+                    item = {
+                        'file': entry.name,
+                        'name': clean_game_name(entry.name),
+                        'size': st.st_size,
+                        'mtime': int(st.st_mtime)
+                    }
+                item['thumb'] = f"{item['name']}.png" in thumbs
+                entries[entry.name] = item
+
+        changed = not cached or entries != cached['entries']
+        if changed:
+            self.version += 1
+        games = cached['games'] if not changed else sorted(
+            entries.values(), key=lambda g: (g['name'].casefold(), g['file']))
+        extensions = {}
+        for name in entries:
+            ext = os.path.splitext(name)[1].lower()
+            extensions[ext] = extensions.get(ext, 0) + 1
+        data = {
+            'rom_mtime': rom_mtime,
+            'thumb_mtime': thumb_mtime,
+            'checked_at': time.time(),
+            'entries': entries,
+            'games': games,
+            'extensions': extensions,
+            'version': self.version if changed else cached['version']
+        }
+        self.consoles[console] = data
+        return data
+
+    def invalidate(self, console):
+        with self.lock:
+            cached = self.consoles.get(console)
+            if cached:
+                cached['checked_at'] = 0
+
+    def summary(self):
+        """Numero de ficheros por extension de cada carpeta de consola"""
+        result = {}
+        version = 0
+        with self.lock:
+            if os.path.isdir(ROMS_DIR):
+                for entry in sorted(os.scandir(ROMS_DIR), key=lambda e: e.name):
+                    if entry.name.startswith('.') or not entry.is_dir():
+                        continue
+                    data = self._refresh(entry.name)
+                    if data:
+                        result[entry.name] = {'total': len(data['games']), 'extensions': data['extensions']}
+                        version = max(version, data['version'])
+        return {'consoles': result, 'version': version}
+
+    def files_with_size(self, size):
+        """(consola, fichero) de las ROMs con ese tamaño.
+
+        Usa lo que ya hay en memoria: solo se leen las consolas que aun no se
+        han cargado, asi una subida no reescanea toda la biblioteca.
+        """
+        result = []
+        with self.lock:
+            if not os.path.isdir(ROMS_DIR):
+                return result
+            for entry in os.scandir(ROMS_DIR):
+                if entry.name.startswith('.') or not entry.is_dir():
+                    continue
+                data = self.consoles.get(entry.name) or self._refresh(entry.name)
+                if data:
+                    result.extend((entry.name, item['file']) for item in data['entries'].values()
+                                  if item['size'] == size)
+        return result
+
+    def find(self, console, name, filename=None):
+        """Entrada de una ROM por nombre limpio (y fichero, si se indica)"""
+        with self.lock:
+            data = self._refresh(console)
+        if not data:
+            return None
+        if filename:
+            item = data['entries'].get(filename)
+            return item if item and item['name'] == name else None
+        return next((g for g in data['games'] if g['name'] == name), None)
+
+    def page(self, console, offset=0, limit=CATALOG_PAGE_SIZE, extensions=None):
+        with self.lock:
+            data = self._refresh(console)
+        if not data:
+            return None
+        games = data['games']
+        if extensions:
+            games = [g for g in games if g['file'].lower().endswith(tuple(extensions))]
+        return {
+            'console': console,
+            'version': data['version'],
+            'total': len(games),
+            'offset': offset,
+            'limit': limit,
+            'games': games[offset:offset + limit]
+        }
+
+
+library_catalog = LibraryCatalog()
+
+
+def hash_rom_file(path):
+    """sha256 y primeros ROM_HEAD_SIZE bytes de un fichero"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        head = f.read(ROM_HEAD_SIZE)
+        sha.update(head)
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest(), head
+
+
+class HashingWriter:
+    """Fichero de escritura que calcula el sha256 de lo que pasa por el"""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha = hashlib.sha256()
+        self.head = bytearray()
+
+    def write(self, data):
+        self.sha.update(data)
+        if len(self.head) < ROM_HEAD_SIZE:
+            self.head += data[:ROM_HEAD_SIZE - len(self.head)]
+        return self.f.write(data)
+
+    def close(self):
+        self.f.close()
+
+
+class RomHashIndex:
+    """Indice de contenido de las ROMs: ruta relativa -> [tamaño, mtime_ns, sha256].
+
+    Una entrada solo vale mientras el fichero conserve tamaño y mtime. Las
+    ROMs que no se subieron por el servidor se hashean bajo demanda, y solo
+    si coinciden en tamaño y cabecera con la que se busca. Los cambios se
+    escriben a disco ROM_INDEX_SAVE_DELAY segundos despues del primero.
+    """
+
+    def __init__(self, path, save_delay=ROM_INDEX_SAVE_DELAY):
+        self.path = path
+        self.save_delay = save_delay
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.files = None
+        self.by_digest = {}
+        self.dirty = False
+        self.timer = None
+
+    def _load(self):
+        if self.files is None:
+            try:
+                with open(self.path) as f:
+                    self.files = json.load(f)
+            except (OSError, ValueError):
+                self.files = {}
+            for rel, entry in self.files.items():
+                self.by_digest.setdefault(entry[2], set()).add(rel)
+        return self.files
+
+    def _set(self, rel, entry):
+        old = self._load().get(rel)
+        if old:
+            self.by_digest.get(old[2], set()).discard(rel)
+        self.files[rel] = entry
+        self.by_digest.setdefault(entry[2], set()).add(rel)
+        self._mark_dirty()
+
+    def _drop(self, rel):
+        entry = self._load().pop(rel, None)
+        if entry:
+            self.by_digest.get(entry[2], set()).discard(rel)
+            self._mark_dirty()
+
+    def _mark_dirty(self):
+        # Con self.lock tomado
+        self.dirty = True
+        if self.timer is None and self.save_delay is not None:
+            self.timer = threading.Timer(self.save_delay, self.save)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _stat(self, rel):
+        try:
+            st = os.stat(os.path.join(ROMS_DIR, rel))
+            return [st.st_size, st.st_mtime_ns]
+        except FileNotFoundError:
+            return None
+
+    def digest(self, rel, compute=True):
+        """sha256 de una ROM (relativa a ROMS_DIR); None si no existe"""
+        stat = self._stat(rel)
+        if stat is None:
+            # ROM borrada: se olvida su entrada
+            with self.lock:
+                self._drop(rel)
+            return None
+        with self.lock:
+            entry = self._load().get(rel)
+        if entry and entry[:2] == stat:
+            return entry[2]
+        if not compute:
+            return None
+        digest, _ = hash_rom_file(os.path.join(ROMS_DIR, rel))
+        with self.lock:
+            self._set(rel, stat + [digest])
+        return digest
+
+    def add(self, rel, digest):
+        stat = self._stat(rel)
+        if stat is not None:
+            with self.lock:
+                self._set(rel, stat + [digest])
+
+    def paths(self, digest):
+        """ROMs indexadas con ese contenido que siguen igual en disco"""
+        with self.lock:
+            self._load()
+            candidates = list(self.by_digest.get(digest, ()))
+        return sorted(rel for rel in candidates if self.digest(rel, compute=False) == digest)
+
+    def duplicates(self, digest, size, head, exclude=None):
+        """Otras ROMs con el mismo contenido que una subida"""
+        found = set(self.paths(digest))
+        for console, fname in library_catalog.files_with_size(size):
+            rel = f"{console}/{fname}"
+            if rel in found or rel == exclude:
+                continue
+            try:
+                with open(os.path.join(ROMS_DIR, rel), 'rb') as f:
+                    if f.read(ROM_HEAD_SIZE) != head:
+                        continue
+            except OSError:
+                continue
+            if self.digest(rel) == digest:
+                found.add(rel)
+        found.discard(exclude)
+        return sorted(found)
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.dirty:
+                    return
+                snapshot = dict(self.files)
+                self.dirty = False
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.path)
+
+
+rom_index = RomHashIndex(ROM_INDEX_PATH)
+
+
+def place_uploaded_rom(tmp_path, rom_path, digest, head):
+    """Mover una subida terminada a su sitio y buscar copias del mismo contenido.
+
+    Con ROM_DEDUP_MODE=hardlink, si el contenido ya existe la ROM se guarda
+    como enlace duro a la copia existente y el temporal se descarta.
+    """
+    rel = os.path.relpath(rom_path, ROMS_DIR)
+    duplicates = []
+    if ROM_DEDUP_MODE in ('report', 'hardlink'):
+        duplicates = rom_index.duplicates(digest, os.path.getsize(tmp_path), bytes(head), exclude=rel)
+    linked = False
+    if duplicates and ROM_DEDUP_MODE == 'hardlink':
+        link_path = f"{tmp_path}.link"
+        try:
+            os.link(os.path.join(ROMS_DIR, duplicates[0]), link_path)
+            os.replace(link_path, rom_path)
+            os.remove(tmp_path)
+            linked = True
+        except OSError as e:
+            log_message(f"Could not hardlink {rel} to {duplicates[0]}: {e}")
+            if os.path.exists(link_path):
+                os.remove(link_path)
+    if not linked:
+        os.replace(tmp_path, rom_path)
+    rom_index.add(rel, digest)
+    if duplicates:
+        log_message(f"ROM {rel} duplicates {', '.join(duplicates)}{' (hardlinked)' if linked else ''}")
+    return {'sha256': digest, 'duplicates': duplicates, 'hardlinked': linked}
+
+
+ZIP64_LIMIT = 0xFFFFFFFF
+
+
+class ZipStreamWriter:
+    """Genera un ZIP sobre un objeto con write() sin volver atras en la salida.
+
+    Cada entrada lleva data descriptor: el CRC y los tamaños se calculan
+    mientras se envia el fichero y se escriben detras de los datos. Pasa a
+    ZIP64 cuando un fichero, un offset o el numero de entradas no caben en
+    el formato clasico.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.offset = 0
+        self.entries = []
+        self.pending = []
+        self.pending_size = 0
+
+    def _write(self, data):
+        if not data:
+            return
+        self.pending.append(data)
+        self.pending_size += len(data)
+        self.offset += len(data)
+        if self.pending_size >= ZIP_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.out.write(b''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    @staticmethod
+    def _dos_datetime(timestamp):
+        t = time.localtime(timestamp)
+        if t.tm_year < 1980:
+            return 0, (1 << 5) | 1
+        return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+                ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+    def add_file(self, path, arcname, compress=True, level=ZIP_DEFLATE_LEVEL):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            name = arcname.encode('utf-8')
+            # Deflate puede crecer un poco con datos incompresibles
+            zip64 = st.st_size >= ZIP64_LIMIT - (1 << 20)
+            method = 8 if compress else 0
+            flags = 0x08 | 0x800  # data descriptor + nombre UTF-8
+            dos_time, dos_date = self._dos_datetime(st.st_mtime)
+            header_offset = self.offset
+            if zip64:
+                extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+                size_field = ZIP64_LIMIT
+            else:
+                extra = b''
+                size_field = 0
+            self._write(struct.pack(
+                '<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, flags, method,
+                dos_time, dos_date, 0, size_field, size_field, len(name), len(extra)
+            ) + name + extra)
+
+            crc = 0
+            size = 0
+            compressed = 0
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if compress else None
+            while True:
+                chunk = f.read(ZIP_CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                compressed += len(chunk)
+                self._write(chunk)
+            if compressor:
+                chunk = compressor.flush()
+                compressed += len(chunk)
+                self._write(chunk)
+
+        if not zip64 and (size >= ZIP64_LIMIT or compressed >= ZIP64_LIMIT):
+            raise ValueError(f"{arcname} grew past 4GB while zipping")
+        if zip64:
+            self._write(struct.pack('<IIQQ', 0x08074b50, crc, compressed, size))
+        else:
+            self._write(struct.pack('<IIII', 0x08074b50, crc, compressed, size))
+        self.entries.append({
+            'name': name, 'crc': crc, 'size': size, 'compressed': compressed,
+            'method': method, 'flags': flags, 'time': dos_time, 'date': dos_date,
+            'offset': header_offset, 'mode': st.st_mode, 'zip64': zip64
+        })
+
+    def close(self):
+        """Escribir el directorio central y el final del ZIP"""
+        cd_offset = self.offset
+        for e in self.entries:
+            fields = []
+            size = e['size']
+            compressed = e['compressed']
+            offset = e['offset']
+            if e['zip64']:
+                fields += [size, compressed]
+                size = compressed = ZIP64_LIMIT
+            if offset >= ZIP64_LIMIT:
+                fields.append(offset)
+                offset = ZIP64_LIMIT
+            extra = struct.pack(f'<HH{len(fields)}Q', 0x0001, 8 * len(fields), *fields) if fields else b''
+            version = 45 if fields else 20
+            self._write(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | version, version,
+                e['flags'], e['method'], e['time'], e['date'], e['crc'],
+                compressed, size, len(e['name']), len(extra), 0, 0, 0,
+                (e['mode'] & 0xFFFF) << 16, offset
+            ) + e['name'] + extra)
+        cd_size = self.offset - cd_offset
+        count = len(self.entries)
+
+        if count >= 0xFFFF or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+            zip64_end = self.offset
+            self._write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45,
+                                    0, 0, count, count, cd_size, cd_offset))
+            self._write(struct.pack('<IIQI', 0x07064b50, 0, zip64_end, 1))
+        self._write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF),
+                                min(count, 0xFFFF), min(cd_size, ZIP64_LIMIT),
+                                min(cd_offset, ZIP64_LIMIT), 0))
+        self.flush()
+
+
+class MultipartError(ValueError):
+    pass
+
+
+class MultipartParser:
+    """Parser incremental de multipart/form-data.
+
+    Lee el cuerpo en bloques de tamaño fijo; las partes con fichero se
+    escriben directamente en el destino que devuelve open_file, asi que la
+    memoria usada no depende del tamaño de la subida.
+    """
+
+    HEADER_LIMIT = 16 * 1024
+    FIELD_LIMIT = 64 * 1024
+
+    def __init__(self, rfile, boundary, content_length, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.rfile = rfile
+        self.remaining = content_length
+        self.chunk_size = chunk_size
+        self.delimiter = b'\r\n--' + boundary
+        # El primer delimitador no lleva CRLF delante; se antepone para
+        # tratarlo igual que el resto
+        self.buf = bytearray(b'\r\n')
+
+    def _fill(self):
+        if self.remaining <= 0:
+            return False
+        data = self.rfile.read(min(self.chunk_size, self.remaining))
+        if not data:
+            raise MultipartError("Unexpected end of body")
+        self.remaining -= len(data)
+        self.buf += data
+        return True
+
+    def _ensure(self, size):
+        while len(self.buf) < size:
+            if not self._fill():
+                raise MultipartError("Unexpected end of body")
+
+    def _read_until_delimiter(self, write):
+        keep = len(self.delimiter) - 1
+        while True:
+            idx = self.buf.find(self.delimiter)
+            if idx != -1:
+                if write and idx:
+                    write(bytes(self.buf[:idx]))
+                del self.buf[:idx + len(self.delimiter)]
+                return
+            if len(self.buf) > keep:
+                if write:
+                    write(bytes(self.buf[:-keep]))
+                del self.buf[:-keep]
+            if not self._fill():
+                raise MultipartError("Closing boundary not found")
+
+    def _next_part(self):
+        self._ensure(2)
+        if self.buf[:2] == b'--':
+            return False
+        if self.buf[:2] != b'\r\n':
+            raise MultipartError("Malformed boundary")
+        del self.buf[:2]
+        return True
+
+    def _read_headers(self):
+        self._ensure(2)
+        if self.buf[:2] == b'\r\n':
+            del self.buf[:2]
+            return {}
+        while True:
+            idx = self.buf.find(b'\r\n\r\n')
+            if idx != -1:
+                break
+            if len(self.buf) > self.HEADER_LIMIT:
+                raise MultipartError("Part headers too large")
+            if not self._fill():
+                raise MultipartError("Unexpected end of body")
+        raw = bytes(self.buf[:idx]).decode('utf-8', 'replace')
+        del self.buf[:idx + 4]
+        headers = {}
+        for line in raw.split('\r\n'):
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        return headers
+
+    def parse(self, open_file):
+        """Procesar el cuerpo completo.
+
+        open_file(name, filename) debe devolver un objeto con write() o None
+        para descartar la parte. Devuelve los campos de texto como dict.
+        """
+        fields = {}
+        self._read_until_delimiter(None)
+        while self._next_part():
+            disposition = self._read_headers().get('content-disposition', '')
+            name = re.search(r'(?:^|;)\s*name="([^"]*)"', disposition)
+            filename = re.search(r'(?:^|;)\s*filename="([^"]*)"', disposition)
+            name = name.group(1) if name else ''
+            if filename:
+                sink = open_file(name, filename.group(1))
+                self._read_until_delimiter(sink.write if sink else None)
+            else:
+                value = bytearray()
+
+                def collect(chunk):
+                    value.extend(chunk)
+                    if len(value) > self.FIELD_LIMIT:
+                        raise MultipartError(f"Field too large: {name}")
+
+                self._read_until_delimiter(collect)
+                fields[name] = value.decode('utf-8', 'replace')
+        return fields
+
+
+def _merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _committed_offset(ranges):
+    """Bytes contiguos recibidos desde el principio del fichero"""
+    if ranges and ranges[0][0] == 0:
+        return ranges[0][1]
+    return 0
+
+
+upload_sessions_lock = threading.Lock()
+upload_session_locks = {}
+
+
+def _upload_session_lock(session_id):
+    with upload_sessions_lock:
+        return upload_session_locks.setdefault(session_id, threading.Lock())
+
+
+def _upload_session_paths(session_id):
+    if not re.fullmatch(r'[0-9a-f]{32}', session_id or ''):
+        raise KeyError(session_id)
+    base = os.path.join(UPLOAD_SESSIONS_DIR, session_id)
+    return base + '.json', base + '.part'
+
+
+def load_upload_session(session_id):
+    meta_path, _ = _upload_session_paths(session_id)
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise KeyError(session_id)
+
+
+def save_upload_session(session):
+    meta_path, _ = _upload_session_paths(session['id'])
+    session['updated_at'] = time.time()
+    tmp = meta_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(session, f)
+    os.replace(tmp, meta_path)
+
+
+def upload_session_view(session):
+    return {
+        'id': session['id'],
+        'folder': session['folder'],
+        'filename': session['filename'],
+        'size': session['size'],
+        'offset': _committed_offset(session['ranges']),
+        'received': session['ranges'],
+        'chunk_size': UPLOAD_SESSION_CHUNK
+    }
+
+
+def purge_upload_sessions():
+    """Borrar sesiones sin actividad desde hace mas de UPLOAD_SESSION_TTL"""
+    if not os.path.isdir(UPLOAD_SESSIONS_DIR):
+        return
+    cutoff = time.time() - UPLOAD_SESSION_TTL
+    for entry in os.scandir(UPLOAD_SESSIONS_DIR):
+        if entry.name.endswith('.json') and entry.stat().st_mtime < cutoff:
+            session_id = entry.name[:-5]
+            try:
+                paths = _upload_session_paths(session_id)
+            except KeyError:
+                continue
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            log_message(f"Upload session expired: {session_id}")
+
+
+def create_upload_session(folder, filename, size):
+    purge_upload_sessions()
+    os.makedirs(UPLOAD_SESSIONS_DIR, exist_ok=True)
+    session = {
+        'id': uuid.uuid4().hex,
+        'folder': folder,
+        'filename': os.path.basename(filename.replace('\\', '/')),
+        'size': size,
+        'ranges': [],
+        'created_at': time.time()
+    }
+    _, data_path = _upload_session_paths(session['id'])
+    with open(data_path, 'wb') as f:
+        f.truncate(size)
+    save_upload_session(session)
+    return session
+
+
+def write_upload_chunk(session_id, offset, length, rfile):
+    """Copiar length bytes de rfile en la posicion offset del fichero parcial"""
+    session = load_upload_session(session_id)
+    if offset < 0 or offset + length > session['size']:
+        raise ValueError("Chunk outside file bounds")
+    _, data_path = _upload_session_paths(session_id)
+    remaining = length
+    # Los chunks de una misma sesion pueden escribirse en paralelo: cada uno
+    # usa su propio descriptor y solo el estado se actualiza bajo lock
+    with open(data_path, 'r+b') as f:
+        f.seek(offset)
+        while remaining > 0:
+            data = rfile.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not data:
+                raise ValueError("Incomplete chunk")
+            f.write(data)
+            remaining -= len(data)
+    with _upload_session_lock(session_id):
+        session = load_upload_session(session_id)
+        if length:
+            session['ranges'] = _merge_ranges(session['ranges'] + [[offset, offset + length]])
+        save_upload_session(session)
+    return session
+
+
+def finalize_upload_session(session_id):
+    with _upload_session_lock(session_id):
+        session = load_upload_session(session_id)
+        if _committed_offset(session['ranges']) < session['size']:
+            raise ValueError("Upload incomplete")
+        meta_path, data_path = _upload_session_paths(session_id)
+        # Las sesiones de otra ejecucion se recargan de disco: se revisa otra vez
+        if not valid_system_name(session['folder']) or not valid_file_name(session['filename']):
+            raise ValueError("Invalid upload folder or filename")
+        rom_dir = os.path.join(ROMS_DIR, session['folder'])
+        os.makedirs(rom_dir, exist_ok=True)
+        rom_path = os.path.join(rom_dir, session['filename'])
+        # Los chunks llegan en paralelo y desordenados: el hash se calcula
+        # con una lectura secuencial al terminar
+        digest, head = hash_rom_file(data_path)
+        dedup = place_uploaded_rom(data_path, rom_path, digest, head)
+        os.remove(meta_path)
+    with upload_sessions_lock:
+        upload_session_locks.pop(session_id, None)
+    return rom_path, dedup
+
+
+def abort_upload_session(session_id):
+    with _upload_session_lock(session_id):
+        load_upload_session(session_id)
+        for path in _upload_session_paths(session_id):
+            if os.path.exists(path):
+                os.remove(path)
+    with upload_sessions_lock:
+        upload_session_locks.pop(session_id, None)
 
 
 class UploadHandler(BaseHTTPRequestHandler):
+    def handle_one_request(self):
+        self._status = None
+        started = time.monotonic()
+        super().handle_one_request()
+        # _status queda a None si la conexion se cerro sin peticion valida
+        if self._status is not None:
+            method = self.command or 'INVALID'
+            route = metric_route(getattr(self, 'path', ''))
+            metrics_requests.inc(method, route, str(self._status))
+            metrics_request_seconds.observe(time.monotonic() - started, method, route)
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+
     def log_message(self, format, *args):
         msg = f"{self.log_date_time_string()} - {format % args}"
         log_message(msg)
@@ -335,33 +3026,71 @@ class UploadHandler(BaseHTTPRequestHandler):
         # Manejar preflight OPTIONS sin duplicar headers
         self.send_response(204)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', '*')
         self.send_header('Access-Control-Max-Age', '86400')
         self.end_headers()
 
-    def do_GET(self):
-        if self.path == '/logs':
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
+    def send_json(self, status, payload):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(json.dumps(payload).encode())
+
+    def send_json_cached(self, payload):
+        """Responder JSON con ETag; 304 si el cliente ya tiene esta version"""
+        body = json.dumps(payload).encode()
+        etag = f'"{zlib.crc32(body):08x}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
-            self.wfile.write(json.dumps({'logs': log_buffer[-100:]}).encode())
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
+        self.end_headers()
+        self.wfile.write(body)
 
+    def do_GET(self):
+        if self.path.startswith('/upload/session/'):
+            self.handle_upload_session_status()
+        elif self.path == '/library' or self.path.startswith('/library?'):
+            self.send_json_cached(library_catalog.summary())
+        elif self.path.startswith('/library/'):
+            self.handle_library_page()
+        elif self.path.startswith('/zip/'):
+            self.handle_zip_download()
+        elif self.path.startswith('/thumbs/grid/'):
+            self.handle_thumb_grid()
+        elif self.path.startswith('/thumbs/atlas/'):
+            self.handle_thumb_atlas_image()
+        elif self.path.startswith('/thumbs/resolve/'):
+            self.handle_thumb_resolve()
+        elif self.path == '/logs' or self.path.startswith('/logs?'):
+            self.handle_logs(log_buffer, 100)
         elif self.path.startswith('/thumbs/status'):
+            self.send_json(200, scan_scheduler.status())
+        elif self.path == '/thumbs/jobs':
+            self.send_json(200, {'jobs': scan_scheduler.list()})
+        elif self.path.startswith('/thumbs/jobs/'):
+            self.handle_scan_job(cancel=False)
+        elif self.path.startswith('/thumbs/events'):
+            self.handle_thumb_events()
+        elif self.path == '/metrics':
+            body = render_metrics().encode()
             self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            with thumb_scan_lock:
-                payload = dict(thumb_scan_state)
-            self.wfile.write(json.dumps(payload).encode())
+            self.wfile.write(body)
         elif self.path.startswith('/thumbs/logs'):
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({'logs': thumb_log_buffer[-200:]}).encode())
+            self.handle_logs(thumb_log_buffer, 200)
         else:
             self.send_response(404)
             self.send_header('Access-Control-Allow-Origin', '*')
@@ -376,14 +3105,438 @@ class UploadHandler(BaseHTTPRequestHandler):
             self.handle_thumbnail_base64()
         elif self.path == '/upload/rom':
             self.handle_rom_upload()
+        elif self.path == '/upload/session':
+            self.handle_upload_session_create()
+        elif self.path.startswith('/upload/session/') and self.path.endswith('/finalize'):
+            self.handle_upload_session_finalize()
         elif self.path == '/thumbs/scan':
             self.handle_thumbs_scan()
+        elif self.path == '/thumbs/atlas':
+            self.handle_thumb_atlas()
+        elif self.path.startswith('/zip/'):
+            self.handle_zip_download()
         else:
             self.send_response(404)
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
 
+    def do_PUT(self):
+        if self.path.startswith('/upload/session/'):
+            self.handle_upload_session_chunk()
+        else:
+            self.send_response(404)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+
+    def do_DELETE(self):
+        if self.path.startswith('/upload/session/'):
+            self.handle_upload_session_abort()
+        elif self.path.startswith('/thumbs/jobs/'):
+            self.handle_scan_job(cancel=True)
+        else:
+            self.send_response(404)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+
+    def handle_logs(self, ring, default_limit):
+        """Lineas de log; con ?since=<seq> solo las posteriores a esa secuencia"""
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        try:
+            since = int(query['since'][0]) if 'since' in query else None
+        except ValueError:
+            self.send_json(400, {'error': 'since must be an integer'})
+            return
+        lines, seq = ring.since(since, default_limit if since is None else None)
+        self.send_json(200, {'logs': lines, 'seq': seq})
+
+    def handle_thumb_events(self):
+        """Stream SSE del escaneo: eventos state (campos que cambian) y log (lineas nuevas)"""
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        last_id = self.headers.get('Last-Event-ID') or query.get('since', [None])[0]
+        try:
+            seq = int(last_id) if last_id else None
+        except ValueError:
+            seq = None
+        if seq is None:
+            # Conexion nueva: el estado va completo y los logs desde ahora
+            _, seq = thumb_log_buffer.since(None, 0)
+        # Con un solo hilo el stream bloquearia el servidor: se envia el
+        # estado y se cierra, y el navegador reconecta (sondeo cada retry ms)
+        max_age = EVENTS_MAX_AGE if isinstance(self.server, (ThreadingHTTPServer, PooledHTTPServer)) else 0
+        if max_age and not event_streams.acquire(blocking=False):
+            self.send_json(503, {'error': 'Too many event streams, poll /thumbs/status instead'})
+            return
+        try:
+            self._stream_thumb_events(seq, max_age)
+        finally:
+            if max_age:
+                event_streams.release()
+
+    def _stream_thumb_events(self, seq, max_age):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+
+        sent_state = {}
+        started = last_write = time.monotonic()
+        try:
+            self.wfile.write(b'retry: 2000\n\n')
+            while True:
+                version = thumb_events.version
+                state = scan_scheduler.status()
+                lines, new_seq = thumb_log_buffer.since(seq)
+                delta = {k: v for k, v in state.items() if k not in sent_state or sent_state[k] != v}
+                events = []
+                for i, line in enumerate(lines, new_seq - len(lines) + 1):
+                    events.append(f"id: {i}\nevent: log\ndata: {json.dumps(line)}\n\n")
+                if delta:
+                    events.append(f"id: {new_seq}\nevent: state\ndata: {json.dumps(delta)}\n\n")
+                now = time.monotonic()
+                if events:
+                    self.wfile.write(''.join(events).encode())
+                    sent_state, seq, last_write = state, new_seq, now
+                elif now - last_write >= EVENTS_HEARTBEAT:
+                    self.wfile.write(b': ping\n\n')
+                    last_write = now
+                self.wfile.flush()
+                if now - started >= max_age:
+                    break
+                # Agrupar rafagas de cambios en un solo envio
+                time.sleep(EVENTS_MIN_INTERVAL)
+                while True:
+                    remaining = EVENTS_HEARTBEAT - (time.monotonic() - last_write)
+                    if remaining <= 0 or thumb_events.wait(version, min(remaining, EVENTS_PEER_CHECK)) != version:
+                        break
+                    if self._peer_closed():
+                        return
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _peer_closed(self):
+        """True si el cliente cerro la conexion (EOF pendiente de leer en el socket)"""
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            return bool(readable) and self.connection.recv(1, socket.MSG_PEEK) == b''
+        except (OSError, ValueError):
+            return True
+
+    def handle_library_page(self):
+        try:
+            parts = urllib.parse.urlsplit(self.path)
+            console = urllib.parse.unquote(parts.path[len('/library/'):]).strip('/')
+            query = urllib.parse.parse_qs(parts.query)
+            offset = max(int(query.get('offset', ['0'])[0]), 0)
+            limit = min(max(int(query.get('limit', [str(CATALOG_PAGE_SIZE)])[0]), 1), 5000)
+            extensions = [e.strip().lower() for e in query.get('ext', [''])[0].split(',') if e.strip()]
+            if not console or '/' in console or console.startswith('.'):
+                self.send_json(400, {'error': 'Invalid console'})
+                return
+            page = library_catalog.page(console, offset, limit, extensions)
+            if page is None:
+                self.send_json(404, {'error': 'Unknown console'})
+                return
+            self.send_json_cached(page)
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+
+    def handle_thumb_grid(self):
+        """Servir la miniatura de un thumbnail para el grid (se genera si falta)"""
+        parts = urllib.parse.urlsplit(self.path)
+        console, _, name = urllib.parse.unquote(parts.path[len('/thumbs/grid/'):]).partition('/')
+        query = urllib.parse.parse_qs(parts.query)
+        try:
+            size = int(query.get('size', [str(THUMB_GRID_SIZES[0])])[0])
+        except ValueError:
+            size = None
+        if size not in THUMB_GRID_SIZES:
+            self.send_json(400, {'error': f'size must be one of {THUMB_GRID_SIZES}'})
+            return
+        if (not console or console.startswith('.') or not name or name.startswith('.')
+                or '/' in name or not name.lower().endswith('.png')):
+            self.send_json(400, {'error': 'Invalid thumbnail'})
+            return
+
+        original = os.path.join(THUMBNAILS_DIR, console, name)
+        try:
+            original_mtime = os.stat(original).st_mtime_ns
+        except FileNotFoundError:
+            self.send_json(404, {'error': 'Thumbnail not found'})
+            return
+        path = thumb_size_path(original, size)
+        try:
+            fresh = os.stat(path).st_mtime_ns >= original_mtime
+        except FileNotFoundError:
+            fresh = False
+        # Thumbnails anteriores a las miniaturas o cambiados desde fuera
+        if not fresh and not render_thumb_sizes(original):
+            path = original
+
+        st = os.stat(path)
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_thumb_resolve(self):
+        """GET /thumbs/resolve/<consola>/<nombre>[?file=<rom>&system=<sistema>]"""
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        console, _, name = url.path[len('/thumbs/resolve/'):].partition('/')
+        console = urllib.parse.unquote(console)
+        name = urllib.parse.unquote(name)
+        if not console or not name or '/' in console or console.startswith('.'):
+            self.send_json(400, {'error': 'Invalid path'})
+            return
+        system = query.get('system', [None])[0]
+        if system is not None and not valid_system_name(system):
+            self.send_json(400, {'error': 'Invalid system'})
+            return
+        # Solo juegos que existen: el nombre acaba siendo un fichero en disco
+        rom = library_catalog.find(console, name, query.get('file', [None])[0])
+        if not rom:
+            self.send_json(404, {'error': 'Unknown game'})
+            return
+        try:
+            source = resolve_thumbnail(console, rom, system)
+        except Exception as e:
+            log_thumb(f"[FAIL] resolve {console}/{name}: {e}")
+            self.send_json(500, {'error': str(e)})
+            return
+        metrics_resolve.inc(source)
+        url = f"/thumbnails/{urllib.parse.quote(console)}/{urllib.parse.quote(name)}.png"
+        if source in ("pending", "busy"):
+            # Otra peticion (o un escaneo) ya lo esta buscando, o no hay hueco:
+            # se responde ya para no retener el worker
+            self.send_response(202 if source == "pending" else 503)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Retry-After', '1')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(json.dumps({'url': url, 'source': source}).encode())
+            return
+        library_catalog.invalidate(console)
+        self.send_json(200, {'url': url, 'source': source})
+
+    def handle_thumb_atlas(self):
+        """Devolver el mapa de un atlas con las miniaturas de varios juegos"""
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(content_length).decode() or '{}')
+            console = data.get('console', '')
+            names = data.get('names', [])
+            size = int(data.get('size', THUMB_GRID_SIZES[0]))
+            inline = bool(data.get('inline', False))
+        except (ValueError, AttributeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        if not console or '/' in console or console.startswith('.'):
+            self.send_json(400, {'error': 'Invalid console'})
+            return
+        if size not in THUMB_GRID_SIZES:
+            self.send_json(400, {'error': f'size must be one of {THUMB_GRID_SIZES}'})
+            return
+        if (not isinstance(names, list) or len(names) > ATLAS_MAX_ITEMS
+                or not all(isinstance(n, str) and n and '/' not in n and not n.startswith('.') for n in names)):
+            self.send_json(400, {'error': f'names must be a list of up to {ATLAS_MAX_ITEMS} games'})
+            return
+        try:
+            self.send_json(200, get_thumb_atlas(console, list(dict.fromkeys(names)), size, inline))
+        except Exception as e:
+            log_message(f"Error building atlas for {console}: {e}")
+            self.send_json(500, {'error': str(e)})
+
+    def handle_thumb_atlas_image(self):
+        key = urllib.parse.urlsplit(self.path).path[len('/thumbs/atlas/'):]
+        path = os.path.join(ATLAS_CACHE_DIR, key)
+        if not re.fullmatch(r'[0-9a-f]{40}\.png', key) or not os.path.isfile(path):
+            self.send_json(404, {'error': 'Atlas not found'})
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        # El nombre depende del contenido: el navegador lo puede guardar siempre
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_zip_download(self):
+        """Enviar un ZIP de una consola (o de los ficheros indicados) al vuelo"""
+        parts = urllib.parse.urlsplit(self.path)
+        console = urllib.parse.unquote(parts.path[len('/zip/'):]).strip('/')
+        query = urllib.parse.parse_qs(parts.query)
+        if not console or '/' in console or console.startswith('.'):
+            self.send_json(400, {'error': 'Invalid console'})
+            return
+
+        files = query.get('files', [])
+        if self.command == 'POST':
+            # Seleccion de ficheros: formulario (files=...&files=...) o JSON
+            content_length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(content_length).decode()
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                try:
+                    files = list(json.loads(body or '{}').get('files', []))
+                except (ValueError, AttributeError):
+                    self.send_json(400, {'error': 'Invalid JSON'})
+                    return
+            else:
+                files = urllib.parse.parse_qs(body).get('files', [])
+
+        method = query.get('method', ['deflate'])[0]
+        if method not in ('deflate', 'stored'):
+            self.send_json(400, {'error': 'method must be deflate or stored'})
+            return
+
+        rom_dir = os.path.join(ROMS_DIR, console)
+        if files:
+            files = [f for f in dict.fromkeys(files)
+                     if f == os.path.basename(f) and not f.startswith('.')
+                     and os.path.isfile(os.path.join(rom_dir, f))]
+        else:
+            extensions = [e.strip().lower() for e in query.get('ext', [''])[0].split(',') if e.strip()]
+            page = library_catalog.page(console, 0, sys.maxsize, extensions)
+            files = [g['file'] for g in page['games']] if page else []
+        if not files:
+            self.send_json(404, {'error': 'No files to download'})
+            return
+
+        name = query.get('name', [f"{console}_ROMs.zip"])[0]
+        name = re.sub(r'[^\w.-]+', '_', os.path.basename(name)) or 'roms.zip'
+        if not name.lower().endswith('.zip'):
+            name += '.zip'
+
+        if not zip_slots.acquire(blocking=False):
+            self.send_response(503)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Retry-After', '5')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(json.dumps({'error': 'Too many ZIP downloads, retry later'}).encode())
+            return
+        try:
+            self._stream_zip(console, rom_dir, files, method, name)
+        finally:
+            zip_slots.release()
+
+    def _stream_zip(self, console, rom_dir, files, method, name):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Disposition', f'attachment; filename="{name}"')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.close_connection = True
+
+        writer = ZipStreamWriter(self.wfile)
+        started = time.time()
+        added = 0
+        try:
+            for fname in files:
+                compress = (method == 'deflate'
+                            and os.path.splitext(fname)[1].lower() not in ZIP_STORED_EXTENSIONS)
+                try:
+                    writer.add_file(os.path.join(rom_dir, fname), fname, compress)
+                    added += 1
+                except FileNotFoundError:
+                    log_message(f"[ZIP] {console}/{fname} disappeared, skipped")
+            writer.close()
+            log_message(f"[ZIP] {console}: {added} files, {writer.offset} bytes in {time.time() - started:.1f}s")
+        except (BrokenPipeError, ConnectionResetError):
+            log_message(f"[ZIP] Client closed the {console} download after {writer.offset} bytes")
+        except (OSError, ValueError) as e:
+            log_message(f"[ZIP] Error streaming {console}: {e}")
+
+    def _upload_session_id(self):
+        path = urllib.parse.urlsplit(self.path).path
+        return path[len('/upload/session/'):].split('/')[0]
+
+    def handle_upload_session_create(self):
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(content_length).decode() or '{}')
+            folder = data.get('folder', '')
+            filename = data.get('filename', '')
+            size = data.get('size')
+            if not folder or not filename or not isinstance(size, int) or size <= 0:
+                self.send_json(400, {'error': 'Missing parameters'})
+                return
+            if not valid_system_name(folder) or not valid_file_name(os.path.basename(filename.replace('\\', '/'))):
+                self.send_json(400, {'error': 'Invalid folder or filename'})
+                return
+            session = create_upload_session(folder, filename, size)
+            log_message(f"Upload session {session['id']}: {session['filename']} to {folder}/ ({size} bytes)")
+            self.send_json(200, upload_session_view(session))
+        except Exception as e:
+            log_message(f"Error creating upload session: {e}")
+            self.send_json(500, {'error': str(e)})
+
+    def handle_upload_session_status(self):
+        try:
+            session = load_upload_session(self._upload_session_id())
+            self.send_json(200, upload_session_view(session))
+        except KeyError:
+            self.send_json(404, {'error': 'Unknown session'})
+
+    def handle_upload_session_chunk(self):
+        session_id = self._upload_session_id()
+        try:
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            offset = int(query.get('offset', ['0'])[0])
+            length = int(self.headers.get('Content-Length', 0))
+            started = time.monotonic()
+            session = write_upload_chunk(session_id, offset, length, self.rfile)
+            record_upload('chunk', length, time.monotonic() - started)
+            self.send_json(200, upload_session_view(session))
+        except KeyError:
+            self.send_json(404, {'error': 'Unknown session'})
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+        except Exception as e:
+            log_message(f"Error in upload chunk {session_id}: {e}")
+            self.send_json(500, {'error': str(e)})
+
+    def handle_upload_session_finalize(self):
+        session_id = self._upload_session_id()
+        try:
+            rom_path, dedup = finalize_upload_session(session_id)
+            log_message(f"ROM uploaded successfully: {rom_path}")
+            library_catalog.invalidate(os.path.basename(os.path.dirname(rom_path)))
+            self.send_json(200, dict({'success': True, 'path': rom_path}, **dedup))
+        except KeyError:
+            self.send_json(404, {'error': 'Unknown session'})
+        except ValueError as e:
+            self.send_json(409, {'error': str(e)})
+        except Exception as e:
+            log_message(f"Error finalizing upload {session_id}: {e}")
+            self.send_json(500, {'error': str(e)})
+
+    def handle_upload_session_abort(self):
+        try:
+            abort_upload_session(self._upload_session_id())
+            self.send_json(200, {'success': True})
+        except KeyError:
+            self.send_json(404, {'error': 'Unknown session'})
+
     def handle_rom_upload(self):
+        upload = {}
         try:
             content_type = self.headers.get('Content-Type', '')
             if not content_type.startswith('multipart/form-data'):
@@ -394,34 +3547,38 @@ class UploadHandler(BaseHTTPRequestHandler):
                 self.wfile.write(b'{"error": "Invalid content type"}')
                 return
 
-            boundary = content_type.split('boundary=')[-1]
+            boundary = re.search(r'boundary="?([^";]+)"?', content_type)
+            if not boundary:
+                raise MultipartError("Missing boundary")
             content_length = int(self.headers.get('Content-Length', 0))
-            body = self.rfile.read(content_length)
 
-            parts = body.split(('--' + boundary).encode())
-
-            folder = None
-            filename = None
-            file_data = None
-
-            for part in parts:
-                if b'Content-Disposition' in part:
-                    if b'name="folder"' in part:
-                        lines = part.split(b'\r\n')
-                        for i, line in enumerate(lines):
-                            if b'name="folder"' in line and i + 2 < len(lines):
-                                folder = lines[i + 2].decode().strip()
-                                break
-
-                    elif b'name="file"' in part:
-                        for line in part.split(b'\r\n'):
-                            if b'filename=' in line:
-                                filename = line.split(b'filename=')[-1].strip(b'"').decode()
-                                break
-                        if b'\r\n\r\n' in part:
-                            file_data = part.split(b'\r\n\r\n', 1)[1].rsplit(b'\r\n', 1)[0]
-
-            if not folder or not file_data or not filename:
+            os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+
+            def open_file(name, filename):
+                if name != 'file' or 'tmp_path' in upload:
+                    return None
+                fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_TMP_DIR, prefix='rom-', suffix='.part')
+                upload['tmp_path'] = tmp_path
+                upload['filename'] = os.path.basename(filename.replace('\\', '/'))
+                upload['file'] = HashingWriter(os.fdopen(fd, 'wb'))
+                return upload['file']
+
+            parser = MultipartParser(self.rfile, boundary.group(1).encode(), content_length)
+            started = time.monotonic()
+            try:
+                fields = parser.parse(open_file)
+            finally:
+                if 'file' in upload:
+                    upload['file'].close()
+            record_upload('multipart', content_length, time.monotonic() - started)
+
+            folder = fields.get('folder', '').strip()
+            filename = upload.get('filename')
+            tmp_path = upload.get('tmp_path')
+
+            if not folder or not filename or not tmp_path or os.path.getsize(tmp_path) == 0:
+                if tmp_path:
+                    os.remove(tmp_path)
                 log_message("Error: Missing data in ROM upload")
                 self.send_response(400)
                 self.send_header('Content-Type', 'application/json')
@@ -430,24 +3587,32 @@ class UploadHandler(BaseHTTPRequestHandler):
                 self.wfile.write(b'{"error": "Missing data"}')
                 return
 
+            if not valid_system_name(folder) or not valid_file_name(filename):
+                os.remove(tmp_path)
+                self.send_json(400, {'error': 'Invalid folder or filename'})
+                return
+
             log_message(f"Uploading ROM: {filename} to {folder}/")
 
             rom_dir = os.path.join(ROMS_DIR, folder)
             os.makedirs(rom_dir, exist_ok=True)
             rom_path = os.path.join(rom_dir, filename)
 
-            with open(rom_path, 'wb') as f:
-                f.write(file_data)
+            dedup = place_uploaded_rom(tmp_path, rom_path, upload['file'].sha.hexdigest(), upload['file'].head)
 
             log_message(f"ROM uploaded successfully: {rom_path}")
+            library_catalog.invalidate(os.path.basename(os.path.dirname(rom_path)))
 
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
-            self.wfile.write(json.dumps({'success': True, 'path': rom_path}).encode())
+            self.wfile.write(json.dumps(dict({'success': True, 'path': rom_path}, **dedup)).encode())
 
         except Exception as e:
+            tmp_path = upload.get('tmp_path')
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
             log_message(f"Error in ROM upload: {e}")
             self.send_response(500)
             self.send_header('Content-Type', 'application/json')
@@ -487,6 +3652,9 @@ class UploadHandler(BaseHTTPRequestHandler):
             b64 = data_url.split(',', 1)[1]
             image_bytes = base64.b64decode(b64)
 
+            if not valid_system_name(folder) or not valid_file_name(f"{game}.png"):
+                self.send_json(400, {'error': 'Invalid folder or game'})
+                return
             thumb_dir = os.path.join(THUMBNAILS_DIR, folder)
             os.makedirs(thumb_dir, exist_ok=True)
             thumb_path = os.path.join(thumb_dir, f"{game}.png")
@@ -495,6 +3663,7 @@ class UploadHandler(BaseHTTPRequestHandler):
                 f.write(image_bytes)
 
             log_message(f"Thumbnail (base64) saved: {thumb_path}")
+            library_catalog.invalidate(folder)
 
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
@@ -511,18 +3680,10 @@ class UploadHandler(BaseHTTPRequestHandler):
             self.wfile.write(json.dumps({'error': str(e)}).encode())
     def handle_thumbs_scan(self):
         try:
-            with thumb_scan_lock:
-                if thumb_scan_state.get('running'):
-                    self.send_response(409)
-                    self.send_header('Content-Type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({'error': 'Scan already running'}).encode())
-                    return
-
             content_length = int(self.headers.get('Content-Length', 0))
             body = self.rfile.read(content_length) if content_length else b'{}'
             data = json.loads(body.decode() or '{}')
+            incremental = isinstance(data, dict) and bool(data.get('incremental'))
 
             consoles = []
             if isinstance(data, dict) and isinstance(data.get('consoles'), list):
@@ -546,20 +3707,26 @@ class UploadHandler(BaseHTTPRequestHandler):
                     {'console': 'gba', 'system': LIBRETRO_MAP.get('gba'), 'extensions': ['.gba']}
                 ]
 
-            def runner():
-                targets = ', '.join([c['console'] for c in consoles])
-                log_thumb(f"[START] scan consoles: {targets}")
-                scan_thumbnails(consoles)
-                log_thumb("[DONE] scan finished")
-
-            t = threading.Thread(target=runner, daemon=True)
-            t.start()
+            # Lista de ROMs concretas: solo para un trabajo de una consola
+            files = data.get('files') if isinstance(data, dict) else None
+            if files is not None:
+                if len(consoles) != 1 or not isinstance(files, list) or not all(isinstance(f, str) for f in files):
+                    self.send_json(400, {'error': 'files must be a list of ROM names for a single console'})
+                    return
+                files = [os.path.basename(f) for f in files]
+            # Sistema y consola acaban en rutas (indices, DATs, carpetas)
+            for c in consoles:
+                if not valid_system_name(c['console']) or (c['system'] is not None and not valid_system_name(c['system'])):
+                    self.send_json(400, {'error': f"Invalid console or system: {c['console']!r}"})
+                    return
+            try:
+                priority = int(data.get('priority', 0)) if isinstance(data, dict) else 0
+            except (TypeError, ValueError):
+                self.send_json(400, {'error': 'priority must be an integer'})
+                return
 
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps({'started': True, 'consoles': [c['console'] for c in consoles]}).encode())
+            job = scan_scheduler.submit(ScanJob(consoles, priority, incremental and files is None, files))
+            self.send_json(200, {'started': True, 'job': job.view(), 'consoles': [c['console'] for c in consoles]})
         except Exception as e:
             log_thumb(f"Error starting scan: {e}")
             self.send_response(500)
@@ -568,6 +3735,16 @@ class UploadHandler(BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(json.dumps({'error': str(e)}).encode())
 
+    def handle_scan_job(self, cancel):
+        """GET /thumbs/jobs/<id> devuelve el trabajo; DELETE lo cancela"""
+        job_id = urllib.parse.urlsplit(self.path).path.rstrip('/').rsplit('/', 1)[-1]
+        try:
+            view = scan_scheduler.cancel(job_id) if cancel else scan_scheduler.view(job_id)
+        except KeyError:
+            self.send_json(404, {'error': 'Unknown job'})
+            return
+        self.send_json(200, view)
+
     def handle_thumbnail_upload(self):
 
         try:
@@ -588,27 +3765,31 @@ class UploadHandler(BaseHTTPRequestHandler):
                 self.wfile.write(b'{"error": "Missing parameters"}')
                 return
 
+            if not valid_system_name(folder) or not valid_file_name(f"{game}.png"):
+                self.send_json(400, {'error': 'Invalid folder or game'})
+                return
+
             log_message(f"Downloading thumbnail for {game} from {url}")
 
-            req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-            with urllib.request.urlopen(req, timeout=30) as response:
-                if response.status == 200:
-                    thumb_dir = os.path.join(THUMBNAILS_DIR, folder)
-                    os.makedirs(thumb_dir, exist_ok=True)
-                    thumb_path = os.path.join(thumb_dir, f"{game}.png")
+            status, image_bytes, _ = http_pool.fetch(url, timeout=30)
+            if status != 200:
+                raise Exception(f'HTTP {status}')
 
-                    with open(thumb_path, 'wb') as f:
-                        f.write(response.read())
+            thumb_dir = os.path.join(THUMBNAILS_DIR, folder)
+            os.makedirs(thumb_dir, exist_ok=True)
+            thumb_path = os.path.join(thumb_dir, f"{game}.png")
 
-                    log_message(f"Thumbnail saved: {thumb_path}")
+            with open(thumb_path, 'wb') as f:
+                f.write(image_bytes)
 
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.send_header('Access-Control-Allow-Origin', '*')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({'success': True, 'path': thumb_path}).encode())
-                else:
-                    raise Exception(f'HTTP {response.status}')
+            log_message(f"Thumbnail saved: {thumb_path}")
+            library_catalog.invalidate(folder)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(json.dumps({'success': True, 'path': thumb_path}).encode())
 
         except Exception as e:
             log_message(f"Error in thumbnail upload: {e}")
@@ -618,17 +3799,83 @@ class UploadHandler(BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(json.dumps({'error': str(e)}).encode())
 
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer que atiende cada conexion en un pool de hilos acotado"""
+
+    def __init__(self, server_address, handler_class, workers=8, max_inflight=32):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http")
+        self.inflight = threading.BoundedSemaphore(max(max_inflight, workers))
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        if not self.inflight.acquire(blocking=False):
+            # Saturado: responder 503 sin ocupar un worker
+            metrics_rejected.inc()
+            try:
+                request.sendall(
+                    b'HTTP/1.0 503 Service Unavailable\r\n'
+                    b'Content-Type: application/json\r\n'
+                    b'Access-Control-Allow-Origin: *\r\n'
+                    b'Retry-After: 1\r\n\r\n'
+                    b'{"error": "Server busy"}'
+                )
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            self.executor.submit(self._process_in_worker, request, client_address)
+        except RuntimeError:
+            # Executor cerrado durante el apagado
+            self.inflight.release()
+            self.shutdown_request(request)
+
+    def _process_in_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.inflight.release()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_server(port, mode=None):
+    """Construir el servidor HTTP segun el modo configurado"""
+    mode = mode or SERVER_MODE
+    address = ('0.0.0.0', port)
+    if mode == "single":
+        return HTTPServer(address, UploadHandler)
+    if mode == "threading":
+        server = ThreadingHTTPServer(address, UploadHandler)
+        server.daemon_threads = True
+        return server
+    if mode != "pool":
+        raise ValueError(f"Unknown server mode: {mode}")
+    return PooledHTTPServer(address, UploadHandler,
+                            workers=SERVER_WORKERS,
+                            max_inflight=SERVER_MAX_INFLIGHT)
+
+
 def main():
-    port = 8080
-    server = HTTPServer(('0.0.0.0', port), UploadHandler)
-    log_message(f"Upload server running on port {port}")
+    port = SERVER_PORT
+    server = create_server(port)
+    log_message(f"Upload server running on port {port} (mode: {SERVER_MODE}, workers: {SERVER_WORKERS}, max in-flight: {SERVER_MAX_INFLIGHT})")
     log_message(f"ROMs dir: {ROMS_DIR}")
     log_message(f"Thumbnails dir: {THUMBNAILS_DIR}")
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         log_message("Server stopped")
-        server.shutdown()
+    finally:
+        server.server_close()
+        http_pool.close()
+        rom_index.save()
+        shutdown_placeholder_pool()
 
 if __name__ == "__main__":
     main()